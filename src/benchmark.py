@@ -0,0 +1,236 @@
+import argparse
+import json
+import platform
+import sys
+import time
+import tracemalloc
+import numpy as np
+from utilities import RerankContext, STRATEGIES
+from embedding_codec import QuantizedEmbeddings
+
+# Benchmarks the rerankers of utilities.STRATEGIES over growing candidate sets.
+# Every case reranks the same embeddings with each strategy, the shared
+# RerankContext construction is reported as its own "context" row.
+#
+#   python benchmark.py --n 20,100,1000,10000 --output ./output/bench.json
+#   python benchmark.py --baseline ./output/bench.json --threshold 1.25
+#   python benchmark.py --quantization-report --source snapshot
+
+
+def parse_ints(value):
+    return [int(x) for x in value.split(",") if x]
+
+
+def synthetic_candidates(n, dim, seed=0):
+    """
+    Clustered unit vectors resembling retrieval candidates, with query
+    similarities that decrease along the relevance order.
+    """
+    rng = np.random.default_rng(seed)
+    centers = rng.normal(size=(max(1, n // 20), dim))
+    vectors = centers[rng.integers(0, len(centers), n)] + 0.5 * rng.normal(size=(n, dim))
+    vectors /= np.linalg.norm(vectors, axis=1, keepdims=True)
+    query_similarities = np.sort(rng.uniform(0.5, 0.95, n))[::-1]
+    return vectors.astype(np.float32), query_similarities
+
+
+def snapshot_candidates(store, n, seed=0):
+    # n rows drawn from every candidate of a snapshot, with their stored certainties
+    rng = np.random.default_rng(seed)
+    rows = np.sort(rng.choice(len(store.vectors), min(n, len(store.vectors)), replace=False))
+    certainties = []
+    with open(f"{store.path}/segments.jsonl", "r") as f:
+        for row, line in enumerate(f):
+            certainties.append(json.loads(line)["certainty"])
+    query_similarities = np.sort(np.asarray(certainties)[rows])[::-1]
+    return np.asarray(store.vectors[rows], dtype=np.float32), query_similarities
+
+
+def measure(function, repeats, max_seconds):
+    """
+    Time repeated calls of function, then run it once more under tracemalloc.
+
+    Returns:
+    - dict: Latency percentiles in milliseconds, the number of timed runs and
+      the peak traced memory in bytes.
+    """
+    function()  # warm-up
+    latencies = []
+    start = time.perf_counter()
+    while len(latencies) < repeats and (not latencies or time.perf_counter() - start < max_seconds):
+        run_start = time.perf_counter()
+        function()
+        latencies.append(time.perf_counter() - run_start)
+
+    tracemalloc.start()
+    function()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    p50, p95, p99 = np.percentile(latencies, [50, 95, 99]) * 1000
+    return {
+        "runs": len(latencies),
+        "mean_ms": float(np.mean(latencies) * 1000),
+        "p50_ms": float(p50),
+        "p95_ms": float(p95),
+        "p99_ms": float(p99),
+        "peak_bytes": int(peak),
+    }
+
+
+def run_benchmark(source, ns, top_ns, dims, strategy_names, repeats=20, max_seconds=10.0, store=None):
+    results = []
+    if source == "snapshot":
+        dims = dims[:1]  # snapshot embeddings have one fixed dimension
+    for dim in dims:
+        for n in ns:
+            if source == "snapshot":
+                vectors, query_similarities = snapshot_candidates(store, n)
+                dim = vectors.shape[1]
+                n = len(vectors)
+            else:
+                vectors, query_similarities = synthetic_candidates(n, dim)
+            context = RerankContext(vectors, query_similarities)
+
+            case = {"source": source, "n": n, "dim": dim}
+            results.append(dict(case, strategy="context", top_n=None, **measure(
+                lambda: RerankContext(vectors, query_similarities), repeats, max_seconds)))
+            for top_n in top_ns:
+                for name in strategy_names:
+                    strategy = STRATEGIES[name]
+                    stats = measure(lambda: strategy(context, top_n=top_n), repeats, max_seconds)
+                    results.append(dict(case, strategy=name, top_n=top_n, **stats))
+                    print(f"{source} n={n} dim={dim} top_n={top_n} {name}: "
+                          f"p50 {stats['p50_ms']:.2f}ms p95 {stats['p95_ms']:.2f}ms peak {stats['peak_bytes'] / 2**20:.1f}MiB", flush=True)
+    return results
+
+
+def quantization_report(candidate_sets, dtypes=("float16", "int8"), top_n=5, strategy_names=None):
+    """
+    Compare the rankings computed from quantized embeddings with the float32 ones.
+
+    Args:
+    - candidate_sets (list): (vectors, query_similarities) pairs, one per query.
+    - dtypes (tuple): Storage dtypes of QuantizedEmbeddings to compare.
+    - top_n (int): Number of documents selected by every strategy.
+    - strategy_names (list): Strategies of STRATEGIES to compare, all by default.
+
+    Returns:
+    - list: Per dtype and strategy the share of queries with identical selections,
+      the mean overlap of the selected sets, the largest Gram matrix error and
+      the bytes per candidate.
+    """
+    strategy_names = list(STRATEGIES) if strategy_names is None else strategy_names
+    reference = []
+    for vectors, query_similarities in candidate_sets:
+        context = RerankContext(vectors, query_similarities)
+        reference.append((context, {name: STRATEGIES[name](context, top_n=top_n) for name in strategy_names}))
+
+    report = []
+    for dtype in dtypes:
+        identical = {name: 0 for name in strategy_names}
+        overlap = {name: 0.0 for name in strategy_names}
+        gram_error, nbytes, rows = 0.0, 0, 0
+        for (vectors, query_similarities), (float_context, float_rankings) in zip(candidate_sets, reference):
+            quantized = QuantizedEmbeddings(vectors, dtype)
+            context = RerankContext(quantized, query_similarities)
+            gram_error = max(gram_error, float(np.abs(context.similarity_matrix - float_context.similarity_matrix).max()))
+            nbytes += quantized.nbytes
+            rows += len(quantized)
+            for name in strategy_names:
+                selected = STRATEGIES[name](context, top_n=top_n)
+                identical[name] += selected == float_rankings[name]
+                overlap[name] += len(set(selected) & set(float_rankings[name])) / max(1, len(selected))
+        for name in strategy_names:
+            report.append({
+                "dtype": dtype,
+                "strategy": name,
+                "identical": identical[name] / len(candidate_sets),
+                "overlap": overlap[name] / len(candidate_sets),
+                "max_gram_error": gram_error,
+                "bytes_per_candidate": nbytes / rows,
+            })
+    return report
+
+
+def result_key(result):
+    return (result["source"], result["strategy"], result["n"], result["top_n"], result["dim"])
+
+
+def find_regressions(results, baseline, threshold):
+    """
+    Compare the p50 latency of every case with the same case in a stored run.
+
+    Returns:
+    - list: (key, baseline p50, current p50) of the cases slower than threshold times the baseline.
+    """
+    baseline_p50 = {result_key(result): result["p50_ms"] for result in baseline["results"]}
+    regressions = []
+    for result in results:
+        key = result_key(result)
+        if key in baseline_p50 and result["p50_ms"] > threshold * baseline_p50[key]:
+            regressions.append((key, baseline_p50[key], result["p50_ms"]))
+    return regressions
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Latency and memory benchmark of the reranking strategies")
+    parser.add_argument("--source", choices=["synthetic", "snapshot"], default="synthetic")
+    parser.add_argument("--snapshot", default="./snapshots/rag24", help="snapshot directory used with --source snapshot")
+    parser.add_argument("--n", type=parse_ints, default=[20, 100, 500, 1000, 5000, 10000], help="comma separated candidate counts")
+    parser.add_argument("--top-n", type=parse_ints, default=[5, 20], help="comma separated top_n values")
+    parser.add_argument("--dim", type=parse_ints, default=[384], help="comma separated embedding dimensions")
+    parser.add_argument("--strategies", default=",".join(STRATEGIES), help=f"comma separated strategies, from {', '.join(STRATEGIES)}")
+    parser.add_argument("--repeats", type=int, default=20, help="timed runs per case")
+    parser.add_argument("--max-seconds", type=float, default=10.0, help="stop repeating a case after this many seconds")
+    parser.add_argument("--output", default=None, help="write the results as JSON")
+    parser.add_argument("--baseline", default=None, help="results JSON to compare against, exits with 1 on a regression")
+    parser.add_argument("--threshold", type=float, default=1.25, help="allowed p50 slowdown factor against the baseline")
+    parser.add_argument("--quantization-report", action="store_true", help="compare float16 and int8 rankings with float32 instead of timing")
+    parser.add_argument("--queries", type=int, default=100, help="number of synthetic candidate sets of the quantization report")
+    args = parser.parse_args()
+
+    strategy_names = args.strategies.split(",")
+    unknown = [name for name in strategy_names if name not in STRATEGIES]
+    if unknown:
+        parser.error(f"unknown strategies: {', '.join(unknown)}")
+
+    store = None
+    if args.source == "snapshot":
+        from snapshot import SnapshotStore
+        store = SnapshotStore(args.snapshot)
+
+    if args.quantization_report:
+        if store is not None:
+            candidate_sets = [store.retrieve(topic, store.depth)[1:] for topic in store.topics]
+        else:
+            candidate_sets = [synthetic_candidates(args.n[0], args.dim[0], seed) for seed in range(args.queries)]
+        report = quantization_report(candidate_sets, top_n=args.top_n[0], strategy_names=strategy_names)
+        print(f"{len(candidate_sets)} queries, float32 uses {4 * len(candidate_sets[0][0][0])} bytes per candidate")
+        for row in report:
+            print(f"{row['dtype']:>8} {row['strategy']:>4}: identical {row['identical']:.1%}, overlap {row['overlap']:.1%}, "
+                  f"max Gram error {row['max_gram_error']:.2e}, {row['bytes_per_candidate']:.0f} bytes per candidate")
+        if args.output is not None:
+            with open(args.output, "w") as f:
+                json.dump({"quantization": report}, f, indent=2)
+        sys.exit(0)
+
+    results = run_benchmark(args.source, args.n, args.top_n, args.dim, strategy_names, args.repeats, args.max_seconds, store)
+    report = {
+        "environment": {"python": platform.python_version(), "numpy": np.__version__, "machine": platform.machine()},
+        "settings": {"repeats": args.repeats, "max_seconds": args.max_seconds},
+        "results": results,
+    }
+    if args.output is not None:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+
+    if args.baseline is not None:
+        with open(args.baseline, "r") as f:
+            baseline = json.load(f)
+        regressions = find_regressions(results, baseline, args.threshold)
+        for key, before, after in regressions:
+            print(f"REGRESSION {key}: p50 {before:.2f}ms -> {after:.2f}ms ({after / before:.2f}x)")
+        if regressions:
+            sys.exit(1)
+        print(f"No regressions beyond {args.threshold}x against {args.baseline}")
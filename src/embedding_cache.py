@@ -0,0 +1,173 @@
+from collections import OrderedDict
+import hashlib
+import json
+import os
+import threading
+import numpy as np
+
+
+class EmbeddingCache:
+    """
+    LRU cache of text embeddings keyed by a content hash of the model name,
+    the normalization setting and the text.
+
+    With a path the embeddings are also written to a memory-mapped float32
+    .npy store (used as a ring buffer of disk_capacity rows) plus a JSON index,
+    so a restarted process starts warm. Lookups that miss in memory fall back
+    to the disk store.
+
+    Args:
+    - model_name (str): Name of the model producing the embeddings.
+    - normalize (bool): Whether the embeddings are normalized.
+    - capacity (int): Maximum number of embeddings kept in memory.
+    - path (str): Optional directory for the on-disk store.
+    - disk_capacity (int): Maximum number of embeddings kept on disk, an existing
+      store keeps the size it was created with.
+    - flush_every (int): Write the disk index after this many new entries.
+    """
+    def __init__(self, model_name, normalize=False, capacity=10000, path=None, disk_capacity=100000, flush_every=100):
+        self.model_name = model_name
+        self.normalize = normalize
+        self.capacity = capacity
+        self.disk_capacity = disk_capacity
+        self.flush_every = flush_every
+        self.memory = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+        self.store_dir = None
+        self.vectors = None
+        self.index = {}
+        self.row_keys = {}
+        self.next_row = 0
+        self.cleared_until = 0
+        self.unflushed = 0
+        if path is not None:
+            # one store per model and normalization setting, they can differ in dimension
+            settings = hashlib.sha256(f"{model_name}\0{normalize}".encode()).hexdigest()[:16]
+            self.store_dir = os.path.join(path, settings)
+            os.makedirs(self.store_dir, exist_ok=True)
+            self.load_index()
+
+    def key(self, text):
+        return hashlib.sha256(f"{self.model_name}\0{self.normalize}\0{text}".encode()).hexdigest()
+
+    def load_index(self):
+        index_path = os.path.join(self.store_dir, "index.json")
+        vectors_path = os.path.join(self.store_dir, "vectors.npy")
+        if os.path.exists(index_path) and os.path.exists(vectors_path):
+            with open(index_path, "r") as f:
+                data = json.load(f)
+            self.index = data["index"]
+            self.next_row = data["next_row"]
+            self.row_keys = {row: key for key, row in self.index.items()}
+            self.vectors = np.load(vectors_path, mmap_mode="r+")
+            # the row numbers of the index only fit the ring size the store was created with
+            self.disk_capacity = len(self.vectors)
+
+    def open_store(self, dim):
+        vectors_path = os.path.join(self.store_dir, "vectors.npy")
+        self.vectors = np.lib.format.open_memmap(vectors_path, mode="w+", dtype=np.float32, shape=(self.disk_capacity, dim))
+
+    def get(self, text):
+        key = self.key(text)
+        with self.lock:
+            embedding = self.memory.get(key)
+            if embedding is not None:
+                self.memory.move_to_end(key)
+                self.hits += 1
+                # a copy, so callers modifying their result can't change the cache
+                return embedding.copy()
+
+            row = self.index.get(key)
+            if row is not None:
+                embedding = np.array(self.vectors[row])
+                self.remember(key, embedding)
+                self.hits += 1
+                return embedding.copy()
+
+            self.misses += 1
+            return None
+
+    def put(self, text, embedding):
+        key = self.key(text)
+        embedding = np.array(embedding, dtype=np.float32)
+        with self.lock:
+            self.remember(key, embedding)
+            if self.store_dir is not None and key not in self.index:
+                self.persist(key, embedding)
+
+    def get_many(self, texts):
+        """
+        Look up several texts at once.
+
+        Returns:
+        - tuple: (embeddings, missing) where embeddings has None for every
+          text not in the cache and missing lists their positions.
+        """
+        embeddings = [self.get(text) for text in texts]
+        missing = [i for i, embedding in enumerate(embeddings) if embedding is None]
+        return embeddings, missing
+
+    def remember(self, key, embedding):
+        self.memory[key] = embedding
+        self.memory.move_to_end(key)
+        while len(self.memory) > self.capacity:
+            self.memory.popitem(last=False)
+
+    def persist(self, key, embedding):
+        if self.vectors is None:
+            self.open_store(len(embedding))
+
+        # the disk store is a ring buffer, the oldest row is overwritten when full
+        row = self.next_row % self.disk_capacity
+        if row in self.row_keys and self.next_row >= self.cleared_until:
+            self.clear_rows(self.next_row, self.flush_every)
+        old_key = self.row_keys.pop(row, None)
+        if old_key is not None:
+            del self.index[old_key]
+        self.vectors[row] = embedding
+        self.index[key] = row
+        self.row_keys[row] = key
+        self.next_row += 1
+
+        self.unflushed += 1
+        if self.unflushed >= self.flush_every:
+            self.write_index()
+
+    def clear_rows(self, start, count):
+        # drop the keys of the next count rows from the index file before they are overwritten,
+        # so a restart without a flush never maps a key to another text's embedding
+        count = min(count, self.disk_capacity)
+        for next_row in range(start, start + count):
+            old_key = self.row_keys.pop(next_row % self.disk_capacity, None)
+            if old_key is not None:
+                del self.index[old_key]
+        self.write_index()
+        self.cleared_until = start + count
+
+    def write_index(self):
+        self.vectors.flush()
+        index_path = os.path.join(self.store_dir, "index.json")
+        with open(index_path + ".tmp", "w") as f:
+            json.dump({"index": self.index, "next_row": self.next_row}, f)
+        os.replace(index_path + ".tmp", index_path)
+        self.unflushed = 0
+
+    def flush(self):
+        with self.lock:
+            if self.vectors is not None and self.unflushed:
+                self.write_index()
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+            "memory_entries": len(self.memory),
+            "memory_capacity": self.capacity,
+            "disk_entries": len(self.index),
+            "disk_capacity": self.disk_capacity if self.store_dir is not None else 0,
+        }
@@ -0,0 +1,74 @@
+import os
+import threading
+from http_client import RetryingClient
+from embedding_codec import decode_embeddings
+from embedding_cache import EmbeddingCache
+from embedding_model import MODEL_NAME
+
+embedding_url = os.environ.get("EMBEDDING_URL", "http://127.0.0.1:8000")
+
+# Pooled client with timeouts and retries, shared by every call to the embedding service
+client = RetryingClient(
+    connect_timeout=float(os.environ.get("EMBEDDING_CONNECT_TIMEOUT", 5)),
+    read_timeout=float(os.environ.get("EMBEDDING_READ_TIMEOUT", 30)),
+)
+
+# Client side cache of query embeddings, persisted next to the service's cache if EMBEDDING_CACHE_DIR is set.
+# Created by the first cached_vectorize call, so importing the client leaves the cache directory alone.
+cache_dir = os.environ.get("EMBEDDING_CACHE_DIR")
+query_cache = None
+query_cache_lock = threading.Lock()
+
+
+def get_query_cache():
+    global query_cache
+    if query_cache is None:
+        with query_cache_lock:
+            if query_cache is None:
+                query_cache = EmbeddingCache(
+                    MODEL_NAME,
+                    normalize=False,
+                    capacity=int(os.environ.get("EMBEDDING_CACHE_SIZE", 10000)),
+                    path=os.path.join(cache_dir, "client") if cache_dir else None,
+                )
+    return query_cache
+
+
+def flush_query_cache():
+    # writes the disk index of the query cache, if it was used
+    if query_cache is not None:
+        query_cache.flush()
+
+
+def parse_embedding_response(response):
+    # binary responses carry shape and dtype in headers, the body is wrapped without copying
+    shape = tuple(int(size) for size in response.headers["X-Embedding-Shape"].split(","))
+    return decode_embeddings(response.content, shape, response.headers["X-Embedding-Dtype"])
+
+
+def vectorize(text, dtype="float32"):
+    """
+    Get the embedding of one text from the embedding service as a NumPy vector.
+    """
+    response = client.post(f"{embedding_url}/vectorize", json={"text": text}, params={"format": "binary", "dtype": dtype})
+    return parse_embedding_response(response)
+
+
+def vectorize_batch(texts, dtype="float32"):
+    """
+    Get the embeddings of several texts in one call as an n x d NumPy matrix.
+    """
+    response = client.post(f"{embedding_url}/vectorize_batch", json={"texts": list(texts)}, params={"format": "binary", "dtype": dtype})
+    return parse_embedding_response(response)
+
+
+def cached_vectorize(text):
+    """
+    Like vectorize, but served from the query embedding cache when possible.
+    """
+    cache = get_query_cache()
+    embedding = cache.get(text)
+    if embedding is None:
+        embedding = vectorize(text)
+        cache.put(text, embedding)
+    return embedding
@@ -0,0 +1,131 @@
+import base64
+import numpy as np
+
+# Wire dtypes, all little-endian
+DTYPES = {
+    "float32": np.dtype("<f4"),
+    "float16": np.dtype("<f2"),
+    "int8": np.dtype("i1"),
+}
+
+
+def quantize(embeddings, dtype="float32"):
+    """
+    Convert a matrix of embeddings to the given wire dtype.
+
+    Args:
+    - embeddings (array-like): n x d embeddings.
+    - dtype (str): One of 'float32', 'float16' or 'int8'.
+
+    Returns:
+    - tuple: (data, scales). For int8 every row is scaled to [-127, 127] and
+      scales holds the float32 per-vector scale, otherwise scales is None.
+    """
+    embeddings = np.asarray(embeddings, dtype=np.float32)
+    if dtype == "int8":
+        scales = np.abs(embeddings).max(axis=1) / 127
+        scales[scales == 0] = 1
+        data = np.rint(embeddings / scales[:, None]).astype(DTYPES["int8"])
+        return data, scales.astype(DTYPES["float32"])
+    return embeddings.astype(DTYPES[dtype]), None
+
+
+def dequantize(data, scales=None):
+    # int8 rows are rescaled, float data is returned as float32
+    if scales is not None:
+        return data.astype(np.float32) * scales[:, None]
+    return data.astype(np.float32, copy=False)
+
+
+def encode_embeddings(embeddings, dtype="float32"):
+    """
+    Serialize an n x d matrix into one contiguous buffer.
+
+    For int8 the buffer starts with the n float32 scales followed by the
+    n x d int8 values, for float32 and float16 it's just the values.
+    """
+    data, scales = quantize(np.atleast_2d(embeddings), dtype)
+    if scales is None:
+        return data.tobytes()
+    return scales.tobytes() + data.tobytes()
+
+
+def decode_embeddings(buffer, shape, dtype="float32"):
+    """
+    Read a buffer written by encode_embeddings back into an array of the given shape.
+
+    float32 and float16 are wrapped with np.frombuffer without copying,
+    int8 is dequantized to float32.
+    """
+    rows = int(np.prod(shape[:-1]))
+    if dtype == "int8":
+        scales = np.frombuffer(buffer, dtype=DTYPES["float32"], count=rows)
+        data = np.frombuffer(buffer, dtype=DTYPES["int8"], offset=scales.nbytes).reshape(rows, shape[-1])
+        return dequantize(data, scales).reshape(shape)
+    return np.frombuffer(buffer, dtype=DTYPES[dtype]).reshape(shape)
+
+
+def to_base64(embeddings, dtype="float32"):
+    embeddings = np.asarray(embeddings)
+    return {
+        "data": base64.b64encode(encode_embeddings(embeddings, dtype)).decode("ascii"),
+        "shape": list(embeddings.shape),
+        "dtype": dtype,
+    }
+
+
+def from_base64(payload):
+    return decode_embeddings(base64.b64decode(payload["data"]), tuple(payload["shape"]), payload["dtype"])
+
+
+class QuantizedEmbeddings:
+    """
+    Unit-normalized embeddings stored as float16, or int8 with per-vector scales.
+
+    At 384 dimensions a row takes 768 bytes as float16 and 388 bytes as int8,
+    against 1536 as float32 and 3072 as float64. The Gram matrix is computed
+    from the stored form block by block: int8 blocks are multiplied as exact
+    integers (in float32, exact up to ~1000 dimensions) and rescaled with the
+    per-vector scales afterwards.
+
+    Args:
+    - embeddings (array-like): n x d embeddings, normalized before quantizing.
+    - dtype (str): 'float16' or 'int8'.
+    """
+    def __init__(self, embeddings, dtype="int8"):
+        X = np.array(embeddings, dtype=np.float32, ndmin=2)
+        norms = np.linalg.norm(X, axis=1, keepdims=True)
+        norms[norms == 0] = 1
+        self.dtype = dtype
+        self.data, self.scales = quantize(X / norms, dtype)
+
+    def __len__(self):
+        return len(self.data)
+
+    @property
+    def nbytes(self):
+        return self.data.nbytes + (0 if self.scales is None else self.scales.nbytes)
+
+    def dequantize(self):
+        return dequantize(self.data, self.scales)
+
+    def gram(self, block_size=1024):
+        """
+        Cosine similarity matrix of the stored embeddings as float32.
+
+        Only two blocks of block_size rows are upcast at a time, the lower
+        triangle is mirrored from the upper one.
+        """
+        n = len(self)
+        G = np.empty((n, n), dtype=np.float32)
+        for i in range(0, n, block_size):
+            rows = self.data[i:i + block_size].astype(np.float32)
+            for j in range(i, n, block_size):
+                cols = rows if j == i else self.data[j:j + block_size].astype(np.float32)
+                G[i:i + block_size, j:j + block_size] = rows @ cols.T
+                if j != i:
+                    G[j:j + block_size, i:i + block_size] = G[i:i + block_size, j:j + block_size].T
+        if self.scales is not None:
+            G *= self.scales[:, None]
+            G *= self.scales[None, :]
+        return G
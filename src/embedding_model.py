@@ -0,0 +1,3 @@
+# Model served by embedding_service, also used by the Weaviate vectorizer and the local index.
+# Kept free of other imports so the service doesn't pull in the client.
+MODEL_NAME = 'sentence-transformers/multi-qa-MiniLM-L6-cos-v1'
@@ -1,25 +1,212 @@
-from fastapi import FastAPI
+from metrics import StartupTimer
+startup = StartupTimer()  # created before the other imports, so they are part of the measured import time
+
+from fastapi import FastAPI, HTTPException, Query, Request
+from fastapi.responses import JSONResponse, Response
 from pydantic import BaseModel
-from sentence_transformers import SentenceTransformer
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager
+from typing import List
+import asyncio
+import logging
+import os
+import threading
 import uvicorn
+from embedding_codec import DTYPES, encode_embeddings, to_base64
+from embedding_cache import EmbeddingCache
+from embedding_model import MODEL_NAME
+import numpy as np
 
-# Define the FastAPI app
-app = FastAPI()
+# Micro-batching settings, concurrent /vectorize calls are collected into one encode call
+MAX_BATCH_SIZE = int(os.environ.get("EMBEDDING_MAX_BATCH_SIZE", 64))
+MAX_WAIT_MS = float(os.environ.get("EMBEDDING_MAX_WAIT_MS", 5))
+
+# Embedding cache settings, set EMBEDDING_CACHE_DIR to keep the cache across restarts
+CACHE_SIZE = int(os.environ.get("EMBEDDING_CACHE_SIZE", 10000))
+CACHE_DIR = os.environ.get("EMBEDDING_CACHE_DIR")
+
+# Set EMBEDDING_WARMUP to run a dummy encode once the model is loaded
+WARMUP = bool(os.environ.get("EMBEDDING_WARMUP"))
+
+logger = logging.getLogger(__name__)
+
+cache = EmbeddingCache(MODEL_NAME, normalize=False, capacity=CACHE_SIZE, path=CACHE_DIR)
+
+# All forward passes run on one worker thread so they never compete for the CPU
+encode_executor = ThreadPoolExecutor(max_workers=1)
+
+startup.mark("import")
+
+# The model is loaded on first use, the lifespan starts loading it in the background
+model = None
+model_lock = threading.Lock()
+
+def get_model():
+    # the startup phases are marked by whichever call loads the model, the warm-up or a later request
+    global model
+    if model is None:
+        with model_lock:
+            if model is None:
+                from sentence_transformers import SentenceTransformer
+                loaded = SentenceTransformer(MODEL_NAME)
+                startup.mark("model_loaded")
+                if WARMUP:
+                    loaded.encode(["warm up"])
+                model = loaded
+                logger.info(f"Embedding model ready after {startup.mark('ready'):.2f}s")
+    return model
+
+
+def warm_up():
+    # load the model in the background, runs on the encode worker
+    try:
+        get_model()
+    except Exception:
+        logger.exception("Loading the embedding model failed, it is retried on the first request")
+
+
+def encode(texts):
+    # only the texts missing from the cache go through the model
+    embeddings, missing = cache.get_many(texts)
+    if missing:
+        encoded = get_model().encode([texts[i] for i in missing], batch_size=MAX_BATCH_SIZE)
+        for i, embedding in zip(missing, encoded):
+            cache.put(texts[i], embedding)
+            embeddings[i] = embedding
+    if not embeddings:
+        return np.empty((0, get_model().get_sentence_embedding_dimension()), dtype=np.float32)
+    return np.stack(embeddings)
+
+
+class MicroBatcher:
+    """
+    Collects concurrent single-text requests for up to max_wait_ms (or until
+    max_batch_size texts are queued) and encodes them with one model call.
+    """
+    def __init__(self, max_batch_size=MAX_BATCH_SIZE, max_wait_ms=MAX_WAIT_MS):
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000
+        self.queue = asyncio.Queue()
 
-# Load the model once on startup
-model = SentenceTransformer('sentence-transformers/multi-qa-MiniLM-L6-cos-v1')
+    async def submit(self, text):
+        future = asyncio.get_running_loop().create_future()
+        await self.queue.put((text, future))
+        return await future
+
+    async def collect(self):
+        loop = asyncio.get_running_loop()
+        batch = [await self.queue.get()]
+        deadline = loop.time() + self.max_wait
+        while len(batch) < self.max_batch_size:
+            timeout = deadline - loop.time()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(await asyncio.wait_for(self.queue.get(), timeout))
+            except asyncio.TimeoutError:
+                break
+        return batch
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = await self.collect()
+            texts = [text for text, _ in batch]
+            try:
+                embeddings = await loop.run_in_executor(encode_executor, encode, texts)
+            except Exception as e:
+                for _, future in batch:
+                    if not future.done():
+                        future.set_exception(e)
+                continue
+            for (_, future), embedding in zip(batch, embeddings):
+                # the caller may have disconnected in the meantime
+                if not future.done():
+                    future.set_result(embedding)
+
+
+batcher = MicroBatcher()
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # start the micro-batching loop and load the model without blocking the startup
+    batch_task = asyncio.create_task(batcher.run())
+    warm_up_task = asyncio.get_running_loop().run_in_executor(encode_executor, warm_up)
+    yield
+    batch_task.cancel()
+    warm_up_task.cancel()
+    cache.flush()
+
+# Define the FastAPI app
+app = FastAPI(lifespan=lifespan)
 
 # Define the request body model
 class TextRequest(BaseModel):
     text: str
 
+class TextBatchRequest(BaseModel):
+    texts: List[str]
+
+def embedding_response(http_request, embeddings, key, response_format, dtype):
+    """
+    Build the response in the negotiated format.
+
+    - json (default): {key: nested float lists}
+    - base64: {key: {"data", "shape", "dtype"}} with the buffer base64 encoded
+    - binary (or Accept: application/octet-stream): the raw little-endian buffer,
+      with shape and dtype in the X-Embedding-Shape and X-Embedding-Dtype headers
+
+    base64 and binary can be quantized to float16 or int8, see embedding_codec.
+    """
+    if response_format == "json":
+        return {key: embeddings.tolist()}
+    if response_format == "base64":
+        return {key: to_base64(embeddings, dtype)}
+    if response_format == "binary":
+        headers = {
+            "X-Embedding-Shape": ",".join(str(size) for size in embeddings.shape),
+            "X-Embedding-Dtype": dtype,
+        }
+        return Response(content=encode_embeddings(embeddings, dtype), media_type="application/octet-stream", headers=headers)
+
+
+def negotiate_format(http_request, response_format, dtype):
+    # checked before encoding, so a bad parameter doesn't cost a model call
+    if dtype not in DTYPES:
+        raise HTTPException(status_code=400, detail=f"Unsupported dtype: {dtype}")
+    if response_format == "json" and "application/octet-stream" in http_request.headers.get("accept", ""):
+        response_format = "binary"
+    if response_format not in ("json", "base64", "binary"):
+        raise HTTPException(status_code=400, detail=f"Unsupported format: {response_format}")
+    return response_format
+
 # Endpoint to get the vector for a text
 @app.post("/vectorize")
-def vectorize_text(request: TextRequest):
+async def vectorize_text(request: TextRequest, http_request: Request, response_format: str = Query("json", alias="format"), dtype: str = "float32"):
+    response_format = negotiate_format(http_request, response_format, dtype)
     text = request.text
-    # Generate the embedding for the input text
-    embedding = model.encode(text).tolist()
-    return {"embedding": embedding}
+    # Generate the embedding for the input text, batched with concurrent requests
+    embedding = await batcher.submit(text)
+    return embedding_response(http_request, embedding, "embedding", response_format, dtype)
+
+# Endpoint to get the vectors for several texts in one call
+@app.post("/vectorize_batch")
+async def vectorize_batch(request: TextBatchRequest, http_request: Request, response_format: str = Query("json", alias="format"), dtype: str = "float32"):
+    response_format = negotiate_format(http_request, response_format, dtype)
+    loop = asyncio.get_running_loop()
+    embeddings = await loop.run_in_executor(encode_executor, encode, request.texts)
+    return embedding_response(http_request, embeddings, "embeddings", response_format, dtype)
+
+# Cache counters, used to size the embedding cache
+@app.get("/cache_stats")
+def cache_stats():
+    return cache.stats()
+
+# Readiness, 503 until the model is loaded (and warmed up when EMBEDDING_WARMUP is set)
+@app.get("/ready")
+def ready():
+    body = {"ready": "ready" in startup.phases, "startup_seconds": startup.phases}
+    return JSONResponse(body, status_code=200 if body["ready"] else 503)
 
 # Run the FastAPI app using Uvicorn
 if __name__ == "__main__":
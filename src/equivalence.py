@@ -0,0 +1,119 @@
+import argparse
+import sys
+import numpy as np
+from sklearn.metrics.pairwise import cosine_similarity
+from utilities import RerankContext, MMR, MMR_batch, diversity_ranker, dartboard, stack_candidates, rerank_grid, parameter_grid
+from benchmark import synthetic_candidates, parse_ints
+
+# Checks that the optimized rerankers select exactly what the original
+# implementations selected, and that rerank_grid selects what the per-topic
+# strategies select, exits with 1 on any difference:
+#
+#   python equivalence.py --cases 200 --n 20,100 --top-n 5,10
+
+
+def reference_MMR(vectors, query_similarities, lambda_param=0.5, top_n=5):
+    # the original list based MMR
+    similarity_matrix = cosine_similarity(np.array(vectors))
+    selected_indices = []
+    candidate_indices = list(range(len(vectors)))
+    for _ in range(top_n):
+        mmr_score = []
+        for candidate in candidate_indices:
+            relevance = query_similarities[candidate]
+            if selected_indices:
+                diversity = max([similarity_matrix[candidate, selected] for selected in selected_indices])
+            else:
+                diversity = 0
+            mmr_score.append((candidate, lambda_param * relevance - (1 - lambda_param) * diversity))
+        selected = max(mmr_score, key=lambda x: x[1])[0]
+        selected_indices.append(selected)
+        candidate_indices.remove(selected)
+    return selected_indices
+
+
+def reference_diversity_ranker(doc_vectors, top_n=5):
+    # the original diversity ranker, which orders every document before slicing
+    similarity_matrix = cosine_similarity(np.array(doc_vectors))
+    ranked_docs = [0]
+    remaining_indices = set(range(len(doc_vectors))) - {0}
+    while remaining_indices:
+        avg_similarities = [(idx, np.mean(similarity_matrix[idx, ranked_docs])) for idx in remaining_indices]
+        next_selected_idx = min(avg_similarities, key=lambda x: x[1])[0]
+        ranked_docs.append(next_selected_idx)
+        remaining_indices.remove(next_selected_idx)
+    return ranked_docs[:top_n]
+
+
+def check_rerankers(cases=100, ns=(20,), top_ns=(5,), lambdas=(0.3, 0.5, 0.7), dim=384):
+    """
+    Compare MMR, MMR_batch and diversity_ranker with the original implementations
+    on synthetic candidate sets.
+
+    Returns:
+    - dict: Reranker name mapped to (mismatching selections, compared selections).
+    """
+    counts = {"mmr": [0, 0], "mmr_batch": [0, 0], "dr": [0, 0]}
+    for n in ns:
+        candidate_sets = [synthetic_candidates(n, dim, seed) for seed in range(cases)]
+        for top_n in top_ns:
+            for lambda_param in lambdas:
+                batch = MMR_batch([vectors for vectors, _ in candidate_sets], [sims for _, sims in candidate_sets], lambda_param, top_n)
+                for (vectors, query_similarities), batch_selected in zip(candidate_sets, batch):
+                    expected = reference_MMR(vectors, query_similarities, lambda_param, min(top_n, n))
+                    selected = MMR(RerankContext(vectors, query_similarities), lambda_param=lambda_param, top_n=top_n)
+                    for name, result in (("mmr", selected), ("mmr_batch", batch_selected)):
+                        counts[name][0] += result != expected
+                        counts[name][1] += 1
+            for vectors, _ in candidate_sets:
+                counts["dr"][0] += diversity_ranker(vectors, top_n) != reference_diversity_ranker(vectors, top_n)
+                counts["dr"][1] += 1
+    return counts
+
+
+def check_grid(topics=100, max_n=50, grid=None, dim=384, seed=0):
+    """
+    Compare rerank_grid with one per-topic strategy call per topic and setting,
+    on synthetic topics of different candidate counts.
+
+    Returns:
+    - dict: Strategy name mapped to (mismatching selections, compared selections).
+    """
+    grid = parameter_grid((3, 5, 10), (0.1, 0.3, 0.7), (0.05, 0.096, 0.2)) if grid is None else grid
+    rng = np.random.default_rng(seed)
+    candidate_sets = [synthetic_candidates(int(rng.integers(1, max_n + 1)), dim, t) for t in range(topics)]
+    vectors, query_similarities, sizes = stack_candidates(*zip(*candidate_sets))
+    indices = rerank_grid(vectors, query_similarities, grid, sizes)
+
+    counts = {}
+    for t, candidates in enumerate(candidate_sets):
+        context = RerankContext(*candidates)
+        for s, setting in enumerate(grid):
+            if setting["strategy"] == "mmr":
+                expected = MMR(context, lambda_param=setting["lambda_param"], top_n=setting["top_n"])
+            elif setting["strategy"] == "db":
+                expected = dartboard(context, top_n=setting["top_n"], sigma=setting["sigma"])
+            else:
+                expected = diversity_ranker(context, top_n=setting["top_n"])
+            selected = [int(i) for i in indices[t, s] if i >= 0]
+            count = counts.setdefault(f"grid_{setting['strategy']}", [0, 0])
+            count[0] += selected != expected
+            count[1] += 1
+    return counts
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Check the rerankers against their original implementations")
+    parser.add_argument("--cases", type=int, default=100, help="synthetic candidate sets per candidate count")
+    parser.add_argument("--n", type=parse_ints, default=[20, 100], help="comma separated candidate counts")
+    parser.add_argument("--top-n", type=parse_ints, default=[5, 10], help="comma separated top_n values")
+    parser.add_argument("--grid-topics", type=int, default=100, help="synthetic topics of the rerank_grid check")
+    args = parser.parse_args()
+
+    counts = check_rerankers(args.cases, args.n, args.top_n)
+    counts.update(check_grid(args.grid_topics))
+    failed = False
+    for name, (mismatches, total) in counts.items():
+        print(f"{name}: {mismatches}/{total} selections differ")
+        failed |= mismatches > 0
+    sys.exit(1 if failed else 0)
@@ -0,0 +1,202 @@
+from contextlib import contextmanager, asynccontextmanager
+from urllib.parse import urlsplit
+import asyncio
+import random
+import threading
+import time
+import httpx
+
+# Status codes worth retrying, everything else >= 400 fails immediately
+RETRY_STATUS = {429, 500, 502, 503, 504}
+
+
+class HTTPClientError(Exception):
+    """Base class of the errors raised by the pooled clients."""
+    def __init__(self, message, url=None):
+        super().__init__(message)
+        self.url = url
+
+class HTTPTimeoutError(HTTPClientError):
+    """The connect or read timeout expired on the last attempt."""
+
+class HTTPConnectionError(HTTPClientError):
+    """The connection couldn't be established or broke on the last attempt."""
+
+class HTTPStatusError(HTTPClientError):
+    """The server answered with an error status."""
+    def __init__(self, message, url=None, status_code=None, body=None):
+        super().__init__(message, url)
+        self.status_code = status_code
+        self.body = body
+
+
+class LatencyRecorder:
+    """
+    Per-endpoint request counters and latencies, shared by every client.
+    An endpoint is the method plus host and path of the URL.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.endpoints = {}
+
+    def record(self, endpoint, seconds, ok=True):
+        with self.lock:
+            entry = self.endpoints.setdefault(endpoint, {"count": 0, "errors": 0, "total_seconds": 0.0, "max_seconds": 0.0})
+            entry["count"] += 1
+            entry["errors"] += 0 if ok else 1
+            entry["total_seconds"] += seconds
+            entry["max_seconds"] = max(entry["max_seconds"], seconds)
+
+    def stats(self):
+        with self.lock:
+            return {
+                endpoint: dict(entry, mean_seconds=entry["total_seconds"] / entry["count"])
+                for endpoint, entry in self.endpoints.items()
+            }
+
+latency = LatencyRecorder()
+
+
+def endpoint_name(method, url):
+    parts = urlsplit(str(url))
+    return f"{method.upper()} {parts.netloc}{parts.path}"
+
+
+def backoff_delay(attempt, backoff, max_backoff):
+    # exponential backoff with full jitter
+    return random.uniform(0, min(max_backoff, backoff * 2 ** attempt))
+
+
+def transport_error(e, endpoint, url):
+    if isinstance(e, httpx.TimeoutException):
+        return HTTPTimeoutError(f"{endpoint} timed out: {e!r}", url)
+    return HTTPConnectionError(f"{endpoint} failed: {e!r}", url)
+
+
+def status_error(response, endpoint):
+    return HTTPStatusError(f"{endpoint} returned {response.status_code}: {response.text[:500]}", str(response.url), response.status_code, response.text)
+
+
+class RetryingClient:
+    """
+    Pooled keep-alive HTTP client with timeouts and bounded retries.
+
+    Timeouts, connection errors and the statuses in RETRY_STATUS are retried up
+    to retries times with jittered exponential backoff, then raised as one of
+    the HTTPClientError subclasses. Every attempt is recorded in latency.
+
+    Args:
+    - connect_timeout (float): Seconds to wait for a connection.
+    - read_timeout (float): Seconds to wait between bytes of the response.
+    - retries (int): Number of retries after the first attempt.
+    - backoff (float): Base delay of the exponential backoff in seconds.
+    - max_backoff (float): Upper bound of a single backoff delay.
+    - max_connections (int): Size of the connection pool.
+    """
+    def __init__(self, connect_timeout=5.0, read_timeout=60.0, retries=3, backoff=0.5, max_backoff=8.0, max_connections=20):
+        self.retries = retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.timeout = httpx.Timeout(read_timeout, connect=connect_timeout)
+        self.limits = httpx.Limits(max_connections=max_connections, max_keepalive_connections=max_connections)
+        self.client = httpx.Client(timeout=self.timeout, limits=self.limits)
+
+    def send(self, method, url, stream=False, **kwargs):
+        endpoint = endpoint_name(method, url)
+        for attempt in range(self.retries + 1):
+            start = time.perf_counter()
+            try:
+                response = self.client.send(self.client.build_request(method, url, **kwargs), stream=stream)
+            except httpx.TransportError as e:
+                error = transport_error(e, endpoint, url)
+            else:
+                if response.status_code < 400:
+                    latency.record(endpoint, time.perf_counter() - start)
+                    return response
+                if stream:
+                    response.read()
+                    response.close()
+                error = status_error(response, endpoint)
+                if response.status_code not in RETRY_STATUS:
+                    latency.record(endpoint, time.perf_counter() - start, ok=False)
+                    raise error
+            latency.record(endpoint, time.perf_counter() - start, ok=False)
+            if attempt == self.retries:
+                raise error
+            time.sleep(backoff_delay(attempt, self.backoff, self.max_backoff))
+
+    def request(self, method, url, **kwargs):
+        return self.send(method, url, **kwargs)
+
+    def get(self, url, **kwargs):
+        return self.send("GET", url, **kwargs)
+
+    def post(self, url, **kwargs):
+        return self.send("POST", url, **kwargs)
+
+    @contextmanager
+    def stream(self, method, url, **kwargs):
+        # retries only cover getting the response headers, not the streamed body
+        response = self.send(method, url, stream=True, **kwargs)
+        try:
+            yield response
+        finally:
+            response.close()
+
+    def close(self):
+        self.client.close()
+
+
+class AsyncRetryingClient(RetryingClient):
+    """
+    Async version of RetryingClient with the same retry policy and errors.
+    Create it inside the event loop that uses it.
+    """
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.client.close()
+        self.client = httpx.AsyncClient(timeout=self.timeout, limits=self.limits)
+
+    async def send(self, method, url, stream=False, **kwargs):
+        endpoint = endpoint_name(method, url)
+        for attempt in range(self.retries + 1):
+            start = time.perf_counter()
+            try:
+                response = await self.client.send(self.client.build_request(method, url, **kwargs), stream=stream)
+            except httpx.TransportError as e:
+                error = transport_error(e, endpoint, url)
+            else:
+                if response.status_code < 400:
+                    latency.record(endpoint, time.perf_counter() - start)
+                    return response
+                if stream:
+                    await response.aread()
+                    await response.aclose()
+                error = status_error(response, endpoint)
+                if response.status_code not in RETRY_STATUS:
+                    latency.record(endpoint, time.perf_counter() - start, ok=False)
+                    raise error
+            latency.record(endpoint, time.perf_counter() - start, ok=False)
+            if attempt == self.retries:
+                raise error
+            await asyncio.sleep(backoff_delay(attempt, self.backoff, self.max_backoff))
+
+    async def request(self, method, url, **kwargs):
+        return await self.send(method, url, **kwargs)
+
+    async def get(self, url, **kwargs):
+        return await self.send("GET", url, **kwargs)
+
+    async def post(self, url, **kwargs):
+        return await self.send("POST", url, **kwargs)
+
+    @asynccontextmanager
+    async def stream(self, method, url, **kwargs):
+        response = await self.send(method, url, stream=True, **kwargs)
+        try:
+            yield response
+        finally:
+            await response.aclose()
+
+    async def close(self):
+        await self.client.aclose()
@@ -1,21 +1,190 @@
-import requests
+import asyncio
+import json
+import logging
+import os
+import re
+import numpy as np
+from http_client import RetryingClient, AsyncRetryingClient
+
+url = os.environ.get("LLM_URL", "https://llm.srv.webis.de/api/generate")
+
+# Timeouts and retries of the LLM calls, the read timeout bounds the wait for the next token
+client_settings = dict(
+    connect_timeout=float(os.environ.get("LLM_CONNECT_TIMEOUT", 10)),
+    read_timeout=float(os.environ.get("LLM_READ_TIMEOUT", 120)),
+    retries=int(os.environ.get("LLM_RETRIES", 2)),
+)
+
+# Context assembly, the retrieved segments of a prompt are limited to CONTEXT_TOKENS tokens
+# of TOKENIZER and segments at least REDUNDANCY_THRESHOLD cosine-similar to an included one are dropped
+CONTEXT_TOKENS = int(os.environ.get("LLM_CONTEXT_TOKENS", 1024))
+REDUNDANCY_THRESHOLD = float(os.environ.get("LLM_REDUNDANCY_THRESHOLD", 0.95))
+# LLM_TOKENIZER should be the generator's tokenizer, as a Hugging Face Hub id or a local tokenizer.json.
+# The default WordPiece tokenizer of the embedding model only approximates it.
+TOKENIZER = os.environ.get("LLM_TOKENIZER", "sentence-transformers/multi-qa-MiniLM-L6-cos-v1")
+# A segment is only trimmed into the remaining budget when at least this many tokens fit
+MIN_TRIM_TOKENS = 32
+
+logger = logging.getLogger(__name__)
+
+# Pooled clients, the async one is created on first use inside the running event loop
+client = RetryingClient(**client_settings)
+async_client = None
+
+def get_async_client():
+    global async_client
+    if async_client is None:
+        async_client = AsyncRetryingClient(**client_settings)
+    return async_client
+
+async def close_async_client():
+    global async_client
+    if async_client is not None:
+        await async_client.close()
+        async_client = None
 
 def llm_request(prompt):
-    url = "https://llm.srv.webis.de/api/generate"
+    # raises an HTTPClientError subclass when the LLM can't be reached or answers with an error
+    data = {
+        "model": "default",
+        "prompt": prompt,
+        "stream": False
+    }
+
+    response = client.post(url, json=data)
+    return response.json()['response']
+
+async def llm_request_async(prompt):
+    # same as llm_request without blocking the event loop
     data = {
         "model": "default",
         "prompt": prompt,
         "stream": False
     }
-    
-    response = requests.post(url, json=data)
-    
-    if response.status_code == 200:
-        return response.json()['response']
-    else:
-        return f"Error: {response.status_code}, {response.text}"
-    
-def generation(query, data):
+
+    response = await get_async_client().post(url, json=data)
+    return response.json()['response']
+
+def llm_stream(prompt):
+    """
+    Stream the completion for a prompt, yielding text chunks as the backend produces them.
+
+    The backend answers with one JSON object per line, each holding the next
+    piece of the response, the last one has "done" set.
+    """
+    data = {
+        "model": "default",
+        "prompt": prompt,
+        "stream": True
+    }
+
+    with client.stream("POST", url, json=data) as response:
+        for line in response.iter_lines():
+            if not line:
+                continue
+            chunk = json.loads(line)
+            if chunk.get("response"):
+                yield chunk["response"]
+            if chunk.get("done"):
+                break
+
+async def llm_stream_async(prompt):
+    # async version of llm_stream, closing the iterator early aborts the upstream request
+    data = {
+        "model": "default",
+        "prompt": prompt,
+        "stream": True
+    }
+
+    async with get_async_client().stream("POST", url, json=data) as response:
+        async for line in response.aiter_lines():
+            if not line:
+                continue
+            chunk = json.loads(line)
+            if chunk.get("response"):
+                yield chunk["response"]
+            if chunk.get("done"):
+                break
+
+# Stand-in when TOKENIZER can't be loaded, every word and punctuation mark counts as one token
+APPROXIMATE_TOKEN = re.compile(r"\w+|[^\w\s]")
+
+tokenizer = None
+
+def get_tokenizer():
+    """
+    The prompt tokenizer, loaded on first use from a local file or the Hugging
+    Face Hub (only the tokenizer files are downloaded).
+
+    Returns:
+    - tokenizers.Tokenizer: The tokenizer, or None when it can't be loaded, e.g.
+      offline. Then tokens are approximated and loading isn't tried again.
+    """
+    global tokenizer
+    if tokenizer is None:
+        try:
+            from tokenizers import Tokenizer
+            if os.path.isfile(TOKENIZER):
+                loaded = Tokenizer.from_file(TOKENIZER)
+            else:
+                loaded = Tokenizer.from_pretrained(TOKENIZER)
+            # a tokenizer.json can carry a fixed truncation or padding length, which would skew the counts
+            loaded.no_truncation()
+            loaded.no_padding()
+            tokenizer = loaded
+        except Exception as e:
+            logger.warning(f"Prompt tokenizer {TOKENIZER} couldn't be loaded, token counts are approximated: {e}")
+            tokenizer = False
+    return tokenizer or None
+
+def token_offsets(segments):
+    # (start, end) character offsets of the tokens of every segment
+    tokenizer = get_tokenizer()
+    if tokenizer is None:
+        return [[match.span() for match in APPROXIMATE_TOKEN.finditer(segment)] for segment in segments]
+    return [encoding.offsets for encoding in tokenizer.encode_batch(list(segments), add_special_tokens=False)]
+
+def assemble_context(segments, vectors=None, budget=CONTEXT_TOKENS, threshold=REDUNDANCY_THRESHOLD):
+    """
+    Select the segments that go into the prompt, in their ranked order.
+
+    A segment is skipped when its embedding is at least threshold cosine-similar
+    to an already selected one. Segments are added while they fit in budget
+    tokens, the first one that doesn't fit is cut at a token boundary if at
+    least MIN_TRIM_TOKENS tokens are left, then assembly stops. Tokens are
+    counted with TOKENIZER, or approximated when it can't be loaded.
+
+    Args:
+    - segments (list): Segment texts, best first.
+    - vectors (array-like): Embeddings of the segments, without them nothing is dropped as redundant.
+    - budget (int): Number of segment tokens allowed in the prompt.
+    - threshold (float): Cosine similarity from which a segment counts as redundant.
+
+    Returns:
+    - list: The selected, possibly trimmed, segment texts.
+    """
+    if vectors is not None and len(segments):
+        vectors = np.asarray(vectors, dtype=np.float32)
+        vectors = vectors / np.maximum(np.linalg.norm(vectors, axis=1, keepdims=True), 1e-12)
+    segment_offsets = token_offsets(segments)
+
+    selected, selected_rows = [], []
+    remaining = budget
+    for i, (segment, offsets) in enumerate(zip(segments, segment_offsets)):
+        if vectors is not None and selected_rows and np.max(vectors[selected_rows] @ vectors[i]) >= threshold:
+            continue
+        if len(offsets) <= remaining:
+            selected.append(segment)
+            selected_rows.append(i)
+            remaining -= len(offsets)
+            continue
+        if remaining >= MIN_TRIM_TOKENS:
+            # the character offset where the last fitting token ends
+            selected.append(segment[:offsets[remaining - 1][1]])
+        break
+    return selected
+
+def build_prompt(query, data):
     prompt = (
     "You will receive a user query and relevant sections retrieved from a database. "
     "Your task is to generate an answer to the query using only the information provided in the retrieved documents. "
@@ -27,7 +196,28 @@ def generation(query, data):
     "If none of the segments answer the question fully say 'No relevant documents for this query'. "
     "User query: {query} "
     )
-    prompt = prompt.format(query=query)
-    for idx, segment in enumerate(data):
-        prompt += "Relevant document" + str(idx+1) + ": " + segment + "\n"
-    return llm_request(prompt)
\ No newline at end of file
+    documents = ["Relevant document" + str(idx+1) + ": " + segment + "\n" for idx, segment in enumerate(data)]
+    return "".join([prompt.format(query=query)] + documents)
+
+# The generation functions take the reranked segments and optionally their embeddings,
+# the prompt only holds what assemble_context keeps of them
+def generation(query, data, vectors=None):
+    return llm_request(build_prompt(query, assemble_context(data, vectors)))
+
+# The async versions tokenize in a worker thread, loading the tokenizer must not block the event loop
+async def generation_async(query, data, vectors=None):
+    context = await asyncio.to_thread(assemble_context, data, vectors)
+    return await llm_request_async(build_prompt(query, context))
+
+def generation_stream(query, data, vectors=None):
+    return llm_stream(build_prompt(query, assemble_context(data, vectors)))
+
+async def generation_stream_async(query, data, vectors=None):
+    context = await asyncio.to_thread(assemble_context, data, vectors)
+    stream = llm_stream_async(build_prompt(query, context))
+    try:
+        async for chunk in stream:
+            yield chunk
+    finally:
+        # closing this generator early aborts the upstream request
+        await stream.aclose()
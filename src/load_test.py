@@ -0,0 +1,57 @@
+import argparse
+import asyncio
+import time
+import httpx
+import numpy as np
+from topics import TopicRegistry, DEFAULT_TOPICS_FILES
+
+# Fires concurrent page requests at readable_documents_service and reports throughput and latency.
+# Run it once with --concurrency 1 and once with a higher value: with a non-blocking request path
+# the throughput grows with the concurrency instead of staying flat.
+
+async def worker(client, url, queue, latencies, errors, view_mode):
+    while True:
+        try:
+            topic = queue.get_nowait()
+        except asyncio.QueueEmpty:
+            return
+        start = time.perf_counter()
+        try:
+            response = await client.get(url, params={"topic": topic, "view_mode": view_mode})
+            response.raise_for_status()
+            latencies.append(time.perf_counter() - start)
+        except httpx.HTTPError:
+            errors.append(topic)
+
+
+async def run(url, topics, concurrency, view_mode):
+    queue = asyncio.Queue()
+    for topic in topics:
+        queue.put_nowait(topic)
+    latencies, errors = [], []
+
+    limits = httpx.Limits(max_connections=concurrency)
+    async with httpx.AsyncClient(timeout=300, limits=limits) as client:
+        start = time.perf_counter()
+        await asyncio.gather(*[worker(client, url, queue, latencies, errors, view_mode) for _ in range(concurrency)])
+        elapsed = time.perf_counter() - start
+
+    print(f"requests: {len(topics)}  concurrency: {concurrency}  errors: {len(errors)}")
+    print(f"elapsed: {elapsed:.2f}s  throughput: {len(latencies) / elapsed:.2f} req/s")
+    if latencies:
+        p50, p95, p99 = np.percentile(latencies, [50, 95, 99])
+        print(f"latency p50: {p50 * 1000:.0f}ms  p95: {p95 * 1000:.0f}ms  p99: {p99 * 1000:.0f}ms")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Load test for readable_documents_service")
+    parser.add_argument("--url", default="http://127.0.0.1:8001/")
+    parser.add_argument("--topics", nargs="+", default=DEFAULT_TOPICS_FILES, help="topic files")
+    parser.add_argument("--requests", type=int, default=50, help="number of requests, cycling through the topics")
+    parser.add_argument("--concurrency", type=int, default=10)
+    parser.add_argument("--view-mode", default="responses")
+    args = parser.parse_args()
+
+    topics = TopicRegistry(args.topics).texts()
+    topics = [topics[i % len(topics)] for i in range(args.requests)]
+    asyncio.run(run(args.url, topics, args.concurrency, args.view_mode))
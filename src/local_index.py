@@ -0,0 +1,227 @@
+import argparse
+import json
+import os
+import numpy as np
+from embedding_model import MODEL_NAME
+
+# Rows scored per matrix multiply, bounds the temporary score buffer
+BLOCK_SIZE = 65536
+
+
+def normalize_rows(vectors):
+    vectors = np.asarray(vectors, dtype=np.float32)
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    norms[norms == 0] = 1
+    return vectors / norms
+
+
+def topk_blocked(vectors, query_vector, top_n, ranges, block_size=BLOCK_SIZE):
+    """
+    Exact top_n inner product search over the given row ranges of vectors.
+
+    Every block of rows is scored with one matrix-vector product and only its
+    own top_n survive, so memory stays at block_size scores.
+
+    Returns:
+    - tuple: Row indices and scores, best first.
+    """
+    best_rows = np.empty(0, dtype=np.int64)
+    best_scores = np.empty(0, dtype=np.float32)
+    for range_start, range_end in ranges:
+        for start in range(range_start, range_end, block_size):
+            end = min(start + block_size, range_end)
+            scores = vectors[start:end] @ query_vector
+            if len(scores) > top_n:
+                keep = np.argpartition(-scores, top_n - 1)[:top_n]
+            else:
+                keep = np.arange(len(scores))
+            best_rows = np.concatenate([best_rows, keep + start])
+            best_scores = np.concatenate([best_scores, scores[keep]])
+            if len(best_scores) > top_n:
+                keep = np.argpartition(-best_scores, top_n - 1)[:top_n]
+                best_rows, best_scores = best_rows[keep], best_scores[keep]
+    order = np.argsort(-best_scores, kind="stable")
+    return best_rows[order], best_scores[order]
+
+
+def assign_clusters(vectors, centroids, block_size=BLOCK_SIZE):
+    labels = np.empty(len(vectors), dtype=np.int64)
+    for start in range(0, len(vectors), block_size):
+        labels[start:start + block_size] = np.argmax(vectors[start:start + block_size] @ centroids.T, axis=1)
+    return labels
+
+
+def spherical_kmeans(vectors, nlist, iterations=10, sample_size=100000, seed=0):
+    """
+    Cluster unit vectors into nlist cells by cosine similarity, trained on a
+    random sample of at most sample_size rows. Empty cells are re-seeded with
+    a random sample row.
+    """
+    rng = np.random.default_rng(seed)
+    sample = vectors[rng.choice(len(vectors), min(sample_size, len(vectors)), replace=False)]
+    centroids = sample[rng.choice(len(sample), nlist, replace=False)].copy()
+    for _ in range(iterations):
+        labels = assign_clusters(sample, centroids)
+        sums = np.zeros_like(centroids)
+        np.add.at(sums, labels, sample)
+        empty = np.bincount(labels, minlength=nlist) == 0
+        sums[empty] = sample[rng.choice(len(sample), int(empty.sum()))]
+        centroids = normalize_rows(sums)
+    return centroids
+
+
+class LocalIndex:
+    """
+    Local stand-in for the Segments collection over a subset of segments.
+
+    An index directory holds
+    - vectors.npy: unit-normalized float32 segment embeddings, memory-mapped on load
+    - segments.jsonl: one line per row with the segment id and text
+    - offsets.npy: byte offset of every row's line in segments.jsonl
+    - index.json: model name, dimension, row count and number of IVF cells
+    - centroids.npy and list_offsets.npy when built with nlist > 0, the rows are
+      then sorted by cell and list_offsets[c]:list_offsets[c+1] are the rows of cell c
+
+    Without cells every query is an exact blocked search over all rows, with
+    cells only the nprobe cells closest to the query are searched.
+
+    Args:
+    - path (str): Index directory written by build_index.
+    - query_vectorizer (callable): Maps a query to its embedding, defaults to a
+      local SentenceTransformer of the model the index was built with.
+    - nprobe (int): Number of IVF cells searched per query.
+    """
+    def __init__(self, path, query_vectorizer=None, nprobe=8):
+        self.path = path
+        with open(os.path.join(path, "index.json"), "r") as f:
+            self.meta = json.load(f)
+        self.vectors = np.load(os.path.join(path, "vectors.npy"), mmap_mode="r")
+        self.offsets = np.load(os.path.join(path, "offsets.npy"))
+        self.nprobe = nprobe
+        self.query_vectorizer = query_vectorizer
+        self.model = None
+        if self.meta["nlist"]:
+            self.centroids = np.load(os.path.join(path, "centroids.npy"))
+            self.list_offsets = np.load(os.path.join(path, "list_offsets.npy"))
+
+    def __len__(self):
+        return self.meta["count"]
+
+    def encode(self, query):
+        if self.query_vectorizer is not None:
+            return self.query_vectorizer(query)
+        if self.model is None:
+            from sentence_transformers import SentenceTransformer
+            self.model = SentenceTransformer(self.meta["model"])
+        return self.model.encode(query)
+
+    def search(self, query_vector, top_n):
+        query_vector = normalize_rows(np.asarray(query_vector).reshape(1, -1))[0]
+        if not self.meta["nlist"]:
+            ranges = [(0, len(self))]
+        else:
+            cells = np.argsort(-(self.centroids @ query_vector))[:self.nprobe]
+            ranges = [(int(self.list_offsets[c]), int(self.list_offsets[c + 1])) for c in np.sort(cells)]
+        return topk_blocked(self.vectors, query_vector, top_n, ranges)
+
+    def read_segments(self, rows):
+        records = []
+        with open(os.path.join(self.path, "segments.jsonl"), "rb") as f:
+            for row in rows:
+                f.seek(int(self.offsets[row]))
+                records.append(json.loads(f.readline()))
+        return records
+
+    def retrieve(self, query, top_n, with_ids=False):
+        rows, scores = self.search(self.encode(query), top_n)
+        records = self.read_segments(rows)
+
+        top_documents = [record["segment"] for record in records]
+        top_vectors = np.ascontiguousarray(self.vectors[rows])
+        # cosine similarity as Weaviate certainty, (1 + cos) / 2
+        query_similarities = [float((1 + score) / 2) for score in scores]
+
+        if with_ids:
+            return top_documents, top_vectors, query_similarities, [record["id"] for record in records]
+        return top_documents, top_vectors, query_similarities
+
+
+def build_index(path, segments, vectors, nlist=0, model_name=MODEL_NAME):
+    """
+    Write a LocalIndex directory.
+
+    Args:
+    - path (str): Index directory, created if missing.
+    - segments (list): Dicts with the "id" and "segment" text of every row.
+    - vectors (np.ndarray): Segment embeddings, one row per segment.
+    - nlist (int): Number of IVF cells, 0 for an exact index.
+    - model_name (str): Model that produced the embeddings, used for the queries.
+    """
+    os.makedirs(path, exist_ok=True)
+    vectors = normalize_rows(vectors)
+
+    nlist = min(nlist, len(segments))
+    if nlist:
+        centroids = spherical_kmeans(vectors, nlist)
+        labels = assign_clusters(vectors, centroids)
+        order = np.argsort(labels, kind="stable")
+        vectors = vectors[order]
+        segments = [segments[i] for i in order]
+        list_offsets = np.concatenate([[0], np.cumsum(np.bincount(labels, minlength=nlist))])
+        np.save(os.path.join(path, "centroids.npy"), centroids)
+        np.save(os.path.join(path, "list_offsets.npy"), list_offsets)
+
+    offsets = np.empty(len(segments), dtype=np.int64)
+    with open(os.path.join(path, "segments.jsonl"), "wb") as f:
+        for row, segment in enumerate(segments):
+            offsets[row] = f.tell()
+            f.write((json.dumps({"id": segment["id"], "segment": segment["segment"]}) + "\n").encode("utf-8"))
+    np.save(os.path.join(path, "offsets.npy"), offsets)
+    np.save(os.path.join(path, "vectors.npy"), vectors)
+
+    with open(os.path.join(path, "index.json"), "w") as f:
+        json.dump({"model": model_name, "dim": int(vectors.shape[1]), "count": len(segments), "nlist": nlist}, f)
+
+
+def segments_from_snapshot(snapshot_path):
+    # the unique segments of a snapshot (see snapshot.py) with the vectors Weaviate stored for them
+    vectors = np.load(os.path.join(snapshot_path, "vectors.npy"), mmap_mode="r")
+    segments, rows, seen = [], [], set()
+    with open(os.path.join(snapshot_path, "segments.jsonl"), "r") as f:
+        for row, line in enumerate(f):
+            record = json.loads(line)
+            if record["id"] not in seen:
+                seen.add(record["id"])
+                segments.append(record)
+                rows.append(row)
+    return segments, np.asarray(vectors[rows])
+
+
+def segments_from_jsonl(segments_path, batch_size=256, model_name=MODEL_NAME):
+    # segments of a JSONL file with "segment" and optional "id" fields, encoded locally
+    from sentence_transformers import SentenceTransformer
+    segments = []
+    with open(segments_path, "r") as f:
+        for row, line in enumerate(f):
+            record = json.loads(line)
+            segments.append({"id": record.get("id", str(row)), "segment": record["segment"]})
+    model = SentenceTransformer(model_name)
+    vectors = model.encode([segment["segment"] for segment in segments], batch_size=batch_size, show_progress_bar=True)
+    return segments, vectors
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Build a local segment index for offline retrieval")
+    source = parser.add_mutually_exclusive_group(required=True)
+    source.add_argument("--snapshot", help="snapshot directory whose segments and vectors are indexed")
+    source.add_argument("--segments", help="JSONL file of segments to encode with the query model")
+    parser.add_argument("--output", default="./indexes/rag24", help="index directory")
+    parser.add_argument("--nlist", type=int, default=0, help="number of IVF cells, 0 builds an exact index")
+    args = parser.parse_args()
+
+    if args.snapshot is not None:
+        segments, vectors = segments_from_snapshot(args.snapshot)
+    else:
+        segments, vectors = segments_from_jsonl(args.segments)
+    build_index(args.output, segments, vectors, args.nlist)
+    print(f"Indexed {len(segments)} segments in {args.output}")
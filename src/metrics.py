@@ -0,0 +1,157 @@
+from contextlib import contextmanager
+import contextvars
+import threading
+import time
+
+# Upper bounds in seconds of the latency histogram buckets
+BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+# Spans finished while handling the current request, None outside of a traced request
+request_spans = contextvars.ContextVar("request_spans", default=None)
+
+
+def escape_label(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def format_labels(labels):
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{name}="{escape_label(value)}"' for name, value in labels) + "}"
+
+
+class Histogram:
+    """
+    Cumulative latency histogram with fixed buckets, one series per label set.
+    """
+    def __init__(self, name, help_text, buckets=BUCKETS):
+        self.name = name
+        self.help_text = help_text
+        self.buckets = buckets
+        self.lock = threading.Lock()
+        self.series = {}
+
+    def observe(self, seconds, **labels):
+        key = tuple(sorted(labels.items()))
+        with self.lock:
+            entry = self.series.setdefault(key, {"counts": [0] * len(self.buckets), "sum": 0.0, "count": 0})
+            for i, bound in enumerate(self.buckets):
+                if seconds <= bound:
+                    entry["counts"][i] += 1
+            entry["sum"] += seconds
+            entry["count"] += 1
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} histogram"]
+        with self.lock:
+            for key, entry in sorted(self.series.items()):
+                for bound, count in zip(self.buckets, entry["counts"]):
+                    lines.append(f"{self.name}_bucket{format_labels(key + (('le', bound),))} {count}")
+                lines.append(f"{self.name}_bucket{format_labels(key + (('le', '+Inf'),))} {entry['count']}")
+                lines.append(f"{self.name}_sum{format_labels(key)} {entry['sum']}")
+                lines.append(f"{self.name}_count{format_labels(key)} {entry['count']}")
+        return lines
+
+
+class Counter:
+    """
+    Monotonic counter, one series per label set.
+    """
+    def __init__(self, name, help_text):
+        self.name = name
+        self.help_text = help_text
+        self.lock = threading.Lock()
+        self.series = {}
+
+    def inc(self, amount=1, **labels):
+        key = tuple(sorted(labels.items()))
+        with self.lock:
+            self.series[key] = self.series.get(key, 0) + amount
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} counter"]
+        with self.lock:
+            for key, value in sorted(self.series.items()):
+                lines.append(f"{self.name}{format_labels(key)} {value}")
+        return lines
+
+
+stage_seconds = Histogram("rag_stage_duration_seconds", "Duration of the pipeline stages.")
+request_seconds = Histogram("rag_request_duration_seconds", "Duration of the HTTP requests until the response headers.")
+requests_total = Counter("rag_requests_total", "Handled HTTP requests.")
+
+
+@contextmanager
+def span(stage, **labels):
+    """
+    Time the enclosed block as one pipeline stage.
+
+    The duration goes into the stage histogram and, inside a traced request,
+    into that request's span list. Failed blocks are recorded with error="true".
+    """
+    start = time.perf_counter()
+    error = False
+    try:
+        yield
+    except BaseException:
+        error = True
+        raise
+    finally:
+        record(stage, time.perf_counter() - start, error, **labels)
+
+
+def record(stage, seconds, error=False, **labels):
+    # a stage timed by the caller, for code that doesn't fit in a with block
+    stage_seconds.observe(seconds, stage=stage, error=str(error).lower(), **labels)
+    spans = request_spans.get()
+    if spans is not None:
+        spans.append((stage, labels, seconds))
+
+
+def start_request_spans():
+    # collect the spans of the current request, returns the list they are appended to
+    spans = []
+    request_spans.set(spans)
+    return spans
+
+
+def server_timing(spans):
+    # spans as a Server-Timing header value, shown per request in the browser's developer tools
+    entries = []
+    for stage, labels, seconds in spans:
+        name = "-".join([stage] + [str(value) for _, value in sorted(labels.items())])
+        entries.append(f"{name};dur={seconds * 1000:.2f}")
+    return ", ".join(entries)
+
+
+def sample_lines(name, help_text, metric_type, samples):
+    # metrics kept elsewhere (caches, HTTP clients), samples is a list of (labels dict, value) pairs
+    lines = [f"# HELP {name} {help_text}", f"# TYPE {name} {metric_type}"]
+    for labels, value in samples:
+        lines.append(f"{name}{format_labels(tuple(sorted(labels.items())))} {value}")
+    return lines
+
+
+def render(extra_lines=()):
+    # every metric in the Prometheus text exposition format
+    lines = stage_seconds.render() + request_seconds.render() + requests_total.render() + list(extra_lines)
+    return "\n".join(lines) + "\n"
+
+
+class StartupTimer:
+    """
+    Seconds from the creation of the timer to named startup phases, e.g. the
+    end of the imports and the moment a service is ready. Create it before the
+    heavy imports of a module.
+    """
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.phases = {}
+
+    def mark(self, phase):
+        self.phases[phase] = time.perf_counter() - self.start
+        return self.phases[phase]
+
+    def lines(self, name="rag_startup_seconds"):
+        return sample_lines(name, "Seconds from process start to the startup phases.", "gauge",
+                            [({"phase": phase}, seconds) for phase, seconds in self.phases.items()])
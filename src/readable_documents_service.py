@@ -1,12 +1,29 @@
-from fastapi import FastAPI, Request
+from metrics import StartupTimer
+startup = StartupTimer()  # created before the other imports, so they are part of the measured import time
+
+from fastapi import FastAPI, Request, HTTPException
 from contextlib import asynccontextmanager
-from fastapi.responses import HTMLResponse
+from fastapi.responses import HTMLResponse, PlainTextResponse, StreamingResponse, Response, JSONResponse
 from typing import List
 import uvicorn
-from weaviate_custom import weaviate_custom
+import os
+import asyncio
+import json
+import time
+import contextvars
+import numpy as np
+from urllib.parse import quote
+from concurrent.futures import ThreadPoolExecutor
+from weaviate_custom import weaviate_custom_async, weaviate_custom_offline_async, weaviate_custom_local_async
+from embedding_client import cached_vectorize, flush_query_cache
 import logging
-from utilities import MMR, diversity_ranker, dartboard
-from llm import generation
+from utilities import RerankContext, STRATEGIES, strategies_signature
+from llm import generation_async, generation_stream_async, close_async_client, get_tokenizer
+from result_cache import TTLCache
+from topics import registry
+from http_client import HTTPClientError, latency
+import metrics
+from metrics import span
 
 
 
@@ -14,55 +31,242 @@ from llm import generation
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
 logger = logging.getLogger(__name__)
 
-weaviate_db = weaviate_custom()
+# set CACHE_QUERY_EMBEDDINGS to embed queries through the cached embedding service instead of Weaviate's vectorizer
+weaviate_db = weaviate_custom_async(query_vectorizer=cached_vectorize if os.environ.get("CACHE_QUERY_EMBEDDINGS") else None)
+# set WEAVIATE_SNAPSHOT to a snapshot directory (see snapshot.py) to serve retrieval offline
+if os.environ.get("WEAVIATE_SNAPSHOT"):
+    weaviate_db = weaviate_custom_offline_async(os.environ["WEAVIATE_SNAPSHOT"])
+# set LOCAL_INDEX to an index directory (see local_index.py) to search segments locally
+elif os.environ.get("LOCAL_INDEX"):
+    weaviate_db = weaviate_custom_local_async(os.environ["LOCAL_INDEX"], nprobe=int(os.environ.get("LOCAL_INDEX_NPROBE", 8)))
+
+# CPU-bound reranking runs on a bounded pool, the semaphore caps the work queued for it
+RERANK_WORKERS = int(os.environ.get("RERANK_WORKERS", 4))
+rerank_executor = ThreadPoolExecutor(max_workers=RERANK_WORKERS)
+rerank_slots = asyncio.Semaphore(RERANK_WORKERS * 2)
+
+# Set WARMUP to run a dummy rerank before reporting ready
+WARMUP = bool(os.environ.get("WARMUP"))
+# Seconds between startup attempts when connecting or warming up fails
+STARTUP_RETRY_SECONDS = float(os.environ.get("STARTUP_RETRY_SECONDS", 5))
+
+# Error of the last failed startup attempt, reported by /ready until an attempt succeeds
+startup_error = None
+
+startup.mark("import")
+
+
+def warm_up():
+    # load the topics and the prompt tokenizer and, with WARMUP, push dummy candidates through every strategy
+    topics.load()
+    get_tokenizer()  # logs a warning and falls back to approximate counts when it can't be loaded
+    if WARMUP:
+        vectors = np.random.default_rng(0).normal(size=(RETRIEVAL_DEPTH, 384)).astype(np.float32)
+        rerank([str(i) for i in range(RETRIEVAL_DEPTH)], vectors, np.linspace(0.9, 0.5, RETRIEVAL_DEPTH), TOP_N)
+
+
+async def start_up():
+    # retried until it succeeds, the service answers in the meantime and /ready reports the last error
+    global startup_error
+    while True:
+        try:
+            if "connected" not in startup.phases:
+                await weaviate_db.db_connect()
+                startup.mark("connected")
+            await asyncio.get_running_loop().run_in_executor(rerank_executor, warm_up)
+        except Exception as e:
+            startup_error = f"{type(e).__name__}: {e}"
+            logger.exception(f"Startup failed, retrying in {STARTUP_RETRY_SECONDS}s")
+            await asyncio.sleep(STARTUP_RETRY_SECONDS)
+            continue
+        startup_error = None
+        logger.info(f"Service ready after {startup.mark('ready'):.2f}s")
+        return
+
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
-    # connect to weaviate db
-    weaviate_db.db_connect()
+    # connect to weaviate db and warm up in the background, /ready tells when it is done
+    start_up_task = asyncio.create_task(start_up())
     yield
-    # disconnect from the db
-    weaviate_db.db_disconnect()
+    # disconnect from the db and the llm, and write the index of the query embedding cache
+    start_up_task.cancel()
+    if "connected" in startup.phases:
+        await weaviate_db.db_disconnect()
+    flush_query_cache()
+    await close_async_client()
+    rerank_executor.shutdown(wait=False)
 
 
 app = FastAPI(lifespan=lifespan)
 
-topics_file_path = './Topics/topics.rag24.test.txt'
-topics = {}
-with open(topics_file_path, 'r') as file:
-    for line in file:
-        parts = line.strip().split('\t')
-        if len(parts) == 2:
-            topics[parts[0]] = parts[1]
+# topics of the files in TOPICS_FILES, read on the first request
+topics = registry
+
+# Number of documents retrieved per topic and kept after reranking
+RETRIEVAL_DEPTH = 20
+TOP_N = 5
 
-topic_values = list(topics.values())
+# Cache layers, each keyed by topic and the parameters of its stage and invalidated independently
+CACHE_TTL = float(os.environ.get("RESULT_CACHE_TTL", 3600))
+caches = {
+    "retrieval": TTLCache("retrieval", capacity=512, ttl=CACHE_TTL),
+    "rerank": TTLCache("rerank", capacity=512, ttl=CACHE_TTL),
+    "generation": TTLCache("generation", capacity=512, ttl=CACHE_TTL),
+}
 
 def rerank(top_documents, top_vectors, query_similarities, top_n = 5):
-    reranked_docs_dict = {
-        "original": top_documents[:top_n],
-        "mmr": [top_documents[i] for i in MMR(top_vectors, query_similarities, 0.3, top_n)],
-        "dr": [top_documents[i] for i in diversity_ranker(top_vectors, top_n)],
-        "db": [top_documents[i] for i in dartboard(top_vectors, query_similarities, top_n)]
-    }
+    # the similarity matrix is computed once and shared by all strategies, each strategy is timed on its own
+    with span("similarity_matrix"):
+        context = RerankContext(top_vectors, query_similarities)
+    reranked_docs_dict = {"original": top_documents[:top_n]}
+    for name, strategy in STRATEGIES.items():
+        with span("rerank_strategy", strategy=name):
+            indices = strategy(context, top_n=top_n)
+        reranked_docs_dict[name] = [top_documents[i] for i in indices]
     return reranked_docs_dict
 
 
+async def cached_retrieve(query):
+    async def compute():
+        if "connected" not in startup.phases:
+            raise ConnectionError(f"Not connected to the database yet ({startup_error or 'still starting up'})")
+        with span("retrieve"):
+            return await weaviate_db.retrieve(query, RETRIEVAL_DEPTH)
+    return await caches["retrieval"].get_or_compute((query, RETRIEVAL_DEPTH), compute)
+
+
+async def cached_rerank(query):
+    async def compute():
+        top_documents, top_vectors, query_similarities = await cached_retrieve(query)
+        async with rerank_slots:
+            loop = asyncio.get_running_loop()
+            # the copied context carries the request's span list into the worker thread
+            with span("rerank"):
+                return await loop.run_in_executor(rerank_executor, contextvars.copy_context().run, rerank, top_documents, top_vectors, query_similarities, TOP_N)
+    key = (query, RETRIEVAL_DEPTH, TOP_N, strategies_signature())
+    return await caches["rerank"].get_or_compute(key, compute)
+
+
+async def segment_vectors(query, documents):
+    # embeddings of reranked documents, taken from the cached retrieval result, for the redundancy check of the prompt
+    top_documents, top_vectors, _ = await cached_retrieve(query)
+    rows = {document: i for i, document in enumerate(top_documents)}
+    return top_vectors[[rows[document] for document in documents]]
+
+
+def generation_key(query, strategy):
+    return (query, RETRIEVAL_DEPTH, TOP_N, strategies_signature(), strategy)
+
+
+async def cached_generation(query, strategy="mmr"):
+    async def compute():
+        reranked_docs_dict = await cached_rerank(query)
+        vectors = await segment_vectors(query, reranked_docs_dict[strategy])
+        with span("generate", strategy=strategy):
+            return await generation_async(query, reranked_docs_dict[strategy], vectors)
+    return await caches["generation"].get_or_compute(generation_key(query, strategy), compute)
+
+
+def sse_event(data, event=None):
+    # one server-sent event, the data is JSON encoded so it stays on one line
+    prefix = f"event: {event}\n" if event else ""
+    return f"{prefix}data: {json.dumps(data)}\n\n"
+
+
+async def stream_generation(request, query, strategy="mmr"):
+    """
+    Yield the generated response as server-sent events while the LLM produces it.
+
+    A cached response is sent as a single event. A fully streamed response is
+    stored in the generation cache. When the client disconnects the upstream
+    LLM request is closed, so abandoned generations stop early.
+    """
+    key = generation_key(query, strategy)
+    entry = caches["generation"].lookup(key)
+    if entry is not None:
+        yield sse_event(entry[1])
+        yield sse_event("", event="done")
+        return
+
+    chunks = []
+    generation = caches["generation"].generation
+    try:
+        reranked_docs_dict = await cached_rerank(query)
+        vectors = await segment_vectors(query, reranked_docs_dict[strategy])
+        stream = generation_stream_async(query, reranked_docs_dict[strategy], vectors)
+        try:
+            with span("generate_stream", strategy=strategy):
+                async for chunk in stream:
+                    if await request.is_disconnected():
+                        logger.info(f"Client disconnected, stopped generation for: {query}")
+                        return
+                    chunks.append(chunk)
+                    yield sse_event(chunk)
+        finally:
+            await stream.aclose()
+    except Exception as e:
+        yield sse_event(f"Error generating response: {str(e)}", event="failure")
+        return
+
+    if caches["generation"].generation == generation:  # not invalidated while streaming
+        caches["generation"].set(key, "".join(chunks))
+    yield sse_event("", event="done")
+
+
+def streaming_response_html(query, strategy="mmr"):
+    # the response view streams the generated answer into the page as it arrives
+    stream_url = f"/generate/stream?topic={quote(query)}&strategy={quote(strategy)}"
+    fallback_url = f"/generate?topic={quote(query)}&strategy={quote(strategy)}"
+    return f"""
+    <h2>Generated Response</h2>
+    <p id="response" style="white-space: pre-wrap;"></p>
+    <script>
+        const source = new EventSource({json.dumps(stream_url)});
+        const target = document.getElementById("response");
+        source.onmessage = (event) => {{ target.textContent += JSON.parse(event.data); }};
+        source.addEventListener("done", () => source.close());
+        source.addEventListener("failure", (event) => {{ target.textContent = JSON.parse(event.data); source.close(); }});
+        source.onerror = () => source.close();
+    </script>
+    <noscript><a href="{fallback_url}">Show the generated response</a></noscript>
+    """
+
+
+# references to running prefetch tasks, so they aren't garbage collected before finishing
+prefetch_tasks = set()
+
+def prefetch_done(task):
+    prefetch_tasks.discard(task)
+    if not task.cancelled() and task.exception() is not None:
+        logger.warning(f"Generation prefetch failed: {task.exception()}")
+
+def prefetch_generation(query, strategy="mmr"):
+    # warm the generation cache in the background without delaying the current response
+    task = asyncio.create_task(cached_generation(query, strategy))
+    prefetch_tasks.add(task)
+    task.add_done_callback(prefetch_done)
+
+
 @app.get("/", response_class=HTMLResponse)
 async def read_root(request: Request):
     topic = request.query_params.get("topic")
     view_mode = request.query_params.get("view_mode", "show")  # Default to 'show'
+    prefetch = request.query_params.get("prefetch") is not None  # Warm the generated response in the background
     document_content = ""
     query = ""
     table_rows = ""
     response_content = ""
 
-    if topic and topic in topic_values:
+    if topic and topic in topics:
         query = topic
         try:
             # Retrieve multiple documents
-            top_documents, top_vectors, query_similarities = weaviate_db.retrieve(query, 20)  # Get more documents for better reranking
-            reranked_docs_dict = rerank(top_documents, top_vectors, query_similarities, 5)  # Rerank top 5 documents
-            response = generation(query, reranked_docs_dict["mmr"])  # Call the generation function
+            top_documents, top_vectors, query_similarities = await cached_retrieve(query)  # Get more documents for better reranking
+            reranked_docs_dict = await cached_rerank(query)  # Rerank top 5 documents
+            # The generation is only computed when its view is requested
+            if view_mode != "responses" and prefetch:
+                prefetch_generation(query, "mmr")
             
             if top_documents:
                 # Create the HTML structure to display the reranked documents side by side
@@ -83,8 +287,8 @@ async def read_root(request: Request):
                     </table>
                     """
                 elif view_mode == "responses":
-                    # Response view, show generated result
-                    response_content = f"<h2>Generated Response</h2><p>{response}</p>"
+                    # Response view, the generated result is streamed in by the page
+                    response_content = streaming_response_html(query, "mmr")
                 else:
                     document_content = ""  # Hide documents
             else:
@@ -92,7 +296,8 @@ async def read_root(request: Request):
         except Exception as e:
             document_content = f"Error retrieving documents: {str(e)}"
     
-    dropdown_options = "".join([f'<option value="{value}">{value}</option>' for value in topic_values])
+    render_start = time.perf_counter()
+    dropdown_options = topics.dropdown_options()
     
     # Switch button changes the view mode
     switch_button = f"""
@@ -143,10 +348,91 @@ async def read_root(request: Request):
         </body>
     </html>
     """
+    metrics.record("render", time.perf_counter() - render_start)
     return HTMLResponse(content=html_content)
 
 
 
+@app.get("/generate", response_class=PlainTextResponse)
+async def generate(topic: str, strategy: str = "mmr"):
+    # generated response on its own, computed once per topic and cached
+    if topic not in topics:
+        raise HTTPException(status_code=404, detail="Unknown topic")
+    if strategy != "original" and strategy not in STRATEGIES:
+        raise HTTPException(status_code=404, detail=f"Unknown strategy: {strategy}")
+    try:
+        return await cached_generation(topic, strategy)
+    except HTTPClientError as e:
+        raise HTTPException(status_code=502, detail=f"Error generating response: {str(e)}")
+
+
+@app.get("/generate/stream")
+async def generate_stream(request: Request, topic: str, strategy: str = "mmr"):
+    # generated response as server-sent events, tokens are forwarded as the LLM produces them
+    if topic not in topics:
+        raise HTTPException(status_code=404, detail="Unknown topic")
+    if strategy != "original" and strategy not in STRATEGIES:
+        raise HTTPException(status_code=404, detail=f"Unknown strategy: {strategy}")
+    return StreamingResponse(stream_generation(request, topic, strategy), media_type="text/event-stream", headers={"Cache-Control": "no-cache"})
+
+
+@app.post("/cache/invalidate")
+def invalidate_cache(layer: str = None, topic: str = None):
+    # drop one layer (or all of them), optionally only for one topic
+    if layer is not None and layer not in caches:
+        raise HTTPException(status_code=404, detail=f"Unknown cache layer: {layer}")
+    predicate = None if topic is None else (lambda key: key[0] == topic)
+    layers = caches if layer is None else {layer: caches[layer]}
+    return {name: cache.invalidate(predicate) for name, cache in layers.items()}
+
+
+@app.get("/cache/stats")
+def cache_stats():
+    return {name: cache.stats() for name, cache in caches.items()}
+
+
+@app.middleware("http")
+async def record_timings(request: Request, call_next):
+    # per-request spans, sent back as a Server-Timing header when asked for with ?timing or X-Timing
+    spans = metrics.start_request_spans()
+    start = time.perf_counter()
+    response = await call_next(request)
+    route = request.scope.get("route")
+    path = route.path if route is not None else "unmatched"
+    metrics.request_seconds.observe(time.perf_counter() - start, path=path)
+    metrics.requests_total.inc(path=path, status=response.status_code)
+    if "timing" in request.query_params or request.headers.get("X-Timing"):
+        response.headers["Server-Timing"] = metrics.server_timing(spans)
+    return response
+
+
+@app.get("/metrics")
+def prometheus_metrics():
+    # stage and request histograms plus the cache and upstream HTTP counters, in Prometheus text format
+    cache_samples = [(name, cache.stats()) for name, cache in caches.items()]
+    upstream = latency.stats()
+    extra_lines = (
+        startup.lines()
+        + metrics.sample_lines("rag_cache_entries", "Entries held by the result caches.", "gauge",
+                               [({"layer": name}, stats["entries"]) for name, stats in cache_samples])
+        + metrics.sample_lines("rag_cache_lookups_total", "Result cache lookups by outcome.", "counter",
+                               [({"layer": name, "result": result}, stats[result]) for name, stats in cache_samples for result in ("hits", "misses", "coalesced")])
+        + metrics.sample_lines("rag_upstream_requests_total", "Upstream HTTP attempts.", "counter",
+                               [({"endpoint": endpoint}, stats["count"]) for endpoint, stats in upstream.items()])
+        + metrics.sample_lines("rag_upstream_errors_total", "Failed upstream HTTP attempts.", "counter",
+                               [({"endpoint": endpoint}, stats["errors"]) for endpoint, stats in upstream.items()])
+        + metrics.sample_lines("rag_upstream_seconds_total", "Time spent in upstream HTTP attempts.", "counter",
+                               [({"endpoint": endpoint}, stats["total_seconds"]) for endpoint, stats in upstream.items()])
+    )
+    return Response(content=metrics.render(extra_lines), media_type="text/plain; version=0.0.4")
+
+
+@app.get("/ready")
+def ready():
+    # 503 until the retrieval backend is connected and the warm-up finished
+    body = {"ready": "ready" in startup.phases, "startup_seconds": startup.phases, "error": startup_error}
+    return JSONResponse(body, status_code=200 if body["ready"] else 503)
+
     
 
 if __name__ == "__main__":
@@ -0,0 +1,116 @@
+from collections import OrderedDict
+import asyncio
+import time
+
+
+class TTLCache:
+    """
+    Async TTL + LRU cache with request coalescing.
+
+    Entries expire ttl seconds after they were computed and the least
+    recently used entry is evicted beyond capacity. Concurrent calls to
+    get_or_compute for the same key share one in-flight computation, which
+    keeps running when a caller is cancelled. Failed computations and
+    results of computations running during an invalidation are not cached.
+
+    Args:
+    - name (str): Name of the cache layer, used in stats.
+    - capacity (int): Maximum number of cached entries.
+    - ttl (float): Time to live of an entry in seconds.
+    """
+    def __init__(self, name, capacity=256, ttl=3600):
+        self.name = name
+        self.capacity = capacity
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        self.in_flight = {}
+        # incremented by invalidate, results computed across an invalidation aren't stored
+        self.generation = 0
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+
+    def lookup(self, key):
+        # returns the (expires, value) entry so cached None values are distinguishable
+        entry = self.entries.get(key)
+        if entry is None:
+            return None
+        expires, value = entry
+        if expires < time.monotonic():
+            del self.entries[key]
+            return None
+        self.entries.move_to_end(key)
+        return entry
+
+    def set(self, key, value):
+        self.entries[key] = (time.monotonic() + self.ttl, value)
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.capacity:
+            self.entries.popitem(last=False)
+
+    async def get_or_compute(self, key, compute):
+        """
+        Return the cached value for key, or await compute() to produce it.
+
+        Args:
+        - key (hashable): Cache key.
+        - compute (callable): Coroutine function without arguments.
+        """
+        entry = self.lookup(key)
+        if entry is not None:
+            self.hits += 1
+            return entry[1]
+
+        # someone is already computing this key, wait for their result
+        task = self.in_flight.get(key)
+        if task is not None:
+            self.coalesced += 1
+        else:
+            self.misses += 1
+            # the computation is its own task, so cancelling one waiting caller doesn't cancel the others
+            task = asyncio.create_task(self.compute_entry(key, compute))
+            self.in_flight[key] = task
+        return await asyncio.shield(task)
+
+    async def compute_entry(self, key, compute):
+        generation = self.generation
+        task = asyncio.current_task()
+        try:
+            value = await compute()
+            if self.generation == generation:
+                self.set(key, value)
+            return value
+        finally:
+            if self.in_flight.get(key) is task:
+                del self.in_flight[key]
+
+    def invalidate(self, predicate=None):
+        """
+        Drop every entry, or only those whose key matches predicate(key).
+
+        Returns:
+        - int: Number of dropped entries.
+        """
+        # running computations may have read invalidated data, later callers start new ones
+        self.generation += 1
+        for key in [key for key in self.in_flight if predicate is None or predicate(key)]:
+            del self.in_flight[key]
+        if predicate is None:
+            dropped = len(self.entries)
+            self.entries.clear()
+            return dropped
+        keys = [key for key in self.entries if predicate(key)]
+        for key in keys:
+            del self.entries[key]
+        return len(keys)
+
+    def stats(self):
+        return {
+            "entries": len(self.entries),
+            "capacity": self.capacity,
+            "ttl": self.ttl,
+            "hits": self.hits,
+            "misses": self.misses,
+            "coalesced": self.coalesced,
+            "in_flight": len(self.in_flight),
+        }
@@ -1,92 +1,261 @@
-import weaviate_custom
-from weaviate.classes.query import MetadataQuery
-from utilities import MMR, diversity_ranker, dartboard
-from visualization import visualize_rankings_with_tsne, visualize_rankings_with_pca
+from weaviate_custom import weaviate_custom, weaviate_custom_offline, weaviate_custom_local
+from embedding_client import cached_vectorize, flush_query_cache
+from utilities import RerankContext, STRATEGIES, rerank_indices
+from topics import TopicRegistry, DEFAULT_TOPICS_FILES
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, as_completed
+import argparse
+import gzip
+import io
 import json
+import os
+import time
+import zlib
 
-def export_docs(reranked_docs_dict, base_output_filename):
-    mmr_file = f"./output/{base_output_filename}_mmr.jsonl"
-    dr_file = f"./output/{base_output_filename}_dr.jsonl"
-    db_file = f"./output/{base_output_filename}_db.jsonl"
-    
-    with open(mmr_file, 'w') as mmr_f, open(dr_file, 'w') as dr_f, open(db_file, 'w') as db_f:
-        for topic, rankings in reranked_docs_dict.items():
-            mmr_data = {
-                "topic": topic,
-                "documents": rankings["mmr"]
-            }
-            dr_data = {
-                "topic": topic,
-                "documents": rankings["dr"]
-            }
-            db_data = {
+def open_compressed(path, mode, compression=None):
+    # text mode file object for plain, gzip or zstd compressed output
+    if compression == "gzip":
+        return gzip.open(path, mode + 't', encoding='utf-8')
+    if compression == "zstd":
+        import zstandard  # optional dependency, only needed for zstd output
+        f = open(path, mode + 'b')
+        if mode == 'r':
+            stream = zstandard.ZstdDecompressor().stream_reader(f, read_across_frames=True, closefd=True)
+        else:
+            stream = zstandard.ZstdCompressor().stream_writer(f, closefd=True)
+        return io.TextIOWrapper(stream, encoding='utf-8')
+    return open(path, mode, encoding='utf-8')
+
+
+def new_decoder(compression):
+    # incremental decoder of a single gzip member or zstd frame
+    if compression == "gzip":
+        return zlib.decompressobj(wbits=31)
+    import zstandard
+    return zstandard.ZstdDecompressor().decompressobj()
+
+
+def complete_length(path, compression=None, chunk_size=1 << 20):
+    """
+    Number of leading bytes of path holding complete records: up to the last
+    newline of a plain file, up to the end of the last intact gzip member or
+    zstd frame of a compressed one.
+    """
+    length, position = 0, 0
+    decoder = None if compression is None else new_decoder(compression)
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            if compression is None:
+                newline = chunk.rfind(b'\n')
+                if newline >= 0:
+                    length = position + newline + 1
+                position += len(chunk)
+                continue
+            while chunk:
+                try:
+                    decoder.decompress(chunk)
+                except Exception:
+                    return length  # corrupted member or frame of a crashed run
+                if not decoder.eof:
+                    position += len(chunk)
+                    break
+                # the member or frame ends inside this chunk, the next one starts in unused_data
+                length = position + len(chunk) - len(decoder.unused_data)
+                position = length
+                chunk = decoder.unused_data
+                decoder = new_decoder(compression)
+    return length
+
+
+class StreamingExporter:
+    """
+    Appends every topic's rankings to one JSONL file per strategy as soon as it is computed.
+
+    Each strategy line holds the topic, the selected segment ids and their query
+    similarity scores. Segment texts are written once to a shared
+    <base>_segments file. Records are buffered and written flush_every topics
+    at a time, every batch is a complete gzip member or zstd frame. When a
+    crashed run is resumed, a torn last batch is cut off before appending, so
+    a crash only loses the current batch.
+
+    Args:
+    - base_output_filename (str): Base name of the files in ./output.
+    - strategies (list): Names of the strategies to export.
+    - compression (str): None, 'gzip' or 'zstd'.
+    - flush_every (int): Number of topics buffered before writing.
+    """
+    suffixes = {None: "", "gzip": ".gz", "zstd": ".zst"}
+
+    def __init__(self, base_output_filename, strategies, compression=None, flush_every=10):
+        self.strategies = list(strategies)
+        self.compression = compression
+        self.flush_every = flush_every
+        suffix = ".jsonl" + self.suffixes[compression]
+        self.paths = {name: f"./output/{base_output_filename}_{name}{suffix}" for name in self.strategies}
+        self.segments_path = f"./output/{base_output_filename}_segments{suffix}"
+        self.buffers = {name: [] for name in self.strategies}
+        self.segments_buffer = []
+        self.written_segments = set()
+        self.exported = {name: set() for name in self.strategies}
+        self.pending_topics = 0
+
+    def finished_topics(self):
+        """
+        Topic ids present in every strategy file, i.e. finished by an earlier run.
+        Cuts off the torn last batch of a crashed run first and remembers the
+        topics and segments already written, so they aren't repeated.
+        """
+        self.check_format()
+        self.drop_incomplete()
+        finished = None
+        for name in self.strategies:
+            self.exported[name] = {record["topic_id"] for record in self.read(self.paths[name])}
+            finished = set(self.exported[name]) if finished is None else finished & self.exported[name]
+        self.written_segments.update(record["id"] for record in self.read(self.segments_path))
+        return finished or set()
+
+    def check_format(self):
+        # files in another format, e.g. the original {"topic", "documents"} exports, are neither resumed nor truncated
+        fields = [(path, "topic_id") for path in self.paths.values()] + [(self.segments_path, "id")]
+        for path, field in fields:
+            for record in self.read(path):
+                if field not in record:
+                    raise ValueError(f"{path} has no {field} field, it wasn't written by this exporter. "
+                                     f"Resume into another --output or move the file away")
+                break
+
+    def drop_incomplete(self):
+        # truncate every file to its last complete record, member or frame, appended batches start clean
+        for path in [*self.paths.values(), self.segments_path]:
+            if os.path.exists(path):
+                length = complete_length(path, self.compression)
+                if length < os.path.getsize(path):
+                    os.truncate(path, length)
+
+    def read(self, path):
+        if not os.path.exists(path):
+            return
+        try:
+            with open_compressed(path, 'r', self.compression) as f:
+                for line in f:
+                    try:
+                        yield json.loads(line)
+                    except json.JSONDecodeError:
+                        return  # partially written last line of a crashed run
+        except EOFError:
+            return  # truncated last batch of a crashed run
+
+    def reset(self):
+        for path in [*self.paths.values(), self.segments_path]:
+            if os.path.exists(path):
+                os.remove(path)
+
+    def add(self, topic_id, topic, rankings, segment_ids, documents, query_similarities):
+        for name in self.strategies:
+            indices = rankings[name]
+            if topic_id in self.exported[name]:
+                continue  # written to this file before a crash between the strategy files
+            self.buffers[name].append({
+                "topic_id": topic_id,
                 "topic": topic,
-                "documents": rankings["db"]
-            }
-            
-            mmr_f.write(json.dumps(mmr_data) + '\n')
-            dr_f.write(json.dumps(dr_data) + '\n')
-            db_f.write(json.dumps(db_data) + '\n')
-
-
-client = weaviate_custom.connect_to_custom(
-    http_host="weaviatedb.srv.webis.de",  
-    http_port=80,                       
-    http_secure=False,   
-    grpc_host="weaviateinference.srv.webis.de",  
-    grpc_port=80,                       
-    grpc_secure=False,
-    skip_init_checks=True,
-)
-
-collection=client.collections.get("Segments")
-
-topics_file_path = './Topics/topics.rag24.test.txt'
-
-topics = {}
-
-with open(topics_file_path, 'r') as file:
-    for line in file:
-        parts = line.strip().split('\t')
-        if len(parts) == 2:
-            topics[parts[0]] = parts[1]
-
-topic_keys = list(topics.keys())
-
-reranked_docs_dict = {}
-counter = 0
-for topic_id in topic_keys:
-    top_documents = []
-    top_vectors = []
-    query_similarities = []
-
-    topic = topics[topic_id]
-    print(topic , '\n')
-
-    response = collection.query.near_text(
-                    query=topic,
-                    limit=20,
-                    return_metadata=MetadataQuery(distance=True, certainty=True)
-                )
-    for o in response.objects:
-        o_with_vector = collection.query.fetch_object_by_id(o.uuid, include_vector= True)
-        vector = o_with_vector.vector['default']
-
-        top_documents.append(o.properties["segment"])
-        top_vectors.append(vector)
-        query_similarities.append(o.metadata.certainty)
-    
-    reranked_docs_dict[topic] = { 
-    "mmr": [top_documents[i] for i in MMR(top_vectors, query_similarities, 0.3)],
-    "dr": [top_documents[i] for i in diversity_ranker(top_vectors)],
-    "db": [top_documents[i] for i in dartboard(top_vectors, query_similarities)]
-}
-
-    counter += 1
-    if counter == 2:
-        break
-
-export_docs(reranked_docs_dict, "reranked_docs")
+                "segment_ids": [segment_ids[i] for i in indices],
+                "scores": [float(query_similarities[i]) for i in indices],
+            })
+            for i in indices:
+                if segment_ids[i] not in self.written_segments:
+                    self.written_segments.add(segment_ids[i])
+                    self.segments_buffer.append({"id": segment_ids[i], "segment": documents[i]})
+
+        self.pending_topics += 1
+        if self.pending_topics >= self.flush_every:
+            self.flush()
+
+    def flush(self):
+        # segments first, a topic found in the strategy files on resume always has its segment texts
+        self.write(self.segments_path, self.segments_buffer)
+        self.segments_buffer = []
+        for name in self.strategies:
+            self.write(self.paths[name], self.buffers[name])
+            self.buffers[name] = []
+        self.pending_topics = 0
+
+    def write(self, path, records):
+        if not records:
+            return
+        with open_compressed(path, 'a', self.compression) as f:
+            f.write("".join(json.dumps(record) + '\n' for record in records))
+
+
+def rerank_topic(top_vectors, query_similarities, top_n, strategy_names):
+    # runs in the rerank process pool, strategies are passed by name so they pickle
+    context = RerankContext(top_vectors, query_similarities)
+    return rerank_indices(context, top_n, {name: STRATEGIES[name] for name in strategy_names})
+
+
+def process_topic(weaviate_db, topic, depth, top_n, strategy_names, rerank_pool):
+    top_documents, top_vectors, query_similarities, segment_ids = weaviate_db.retrieve(topic, depth, with_ids=True)
+    if rerank_pool is None:
+        rankings = rerank_topic(top_vectors, query_similarities, top_n, strategy_names)
+    else:
+        rankings = rerank_pool.submit(rerank_topic, top_vectors, query_similarities, top_n, strategy_names).result()
+    return rankings, segment_ids, top_documents, query_similarities
+
+
+def run(topics, weaviate_db, exporter, depth=20, top_n=5, concurrency=8, rerank_workers=0, resume=False):
+    """
+    Retrieve and rerank every topic, concurrency topics at a time.
+
+    Retrieval runs on a thread pool, reranking on a process pool of
+    rerank_workers processes (inline when 0). Every finished topic is handed
+    to the exporter right away, so a run started with resume=True skips the
+    topics an interrupted run already exported. Failing topics are logged and skipped.
+    """
+    if resume:
+        finished = exporter.finished_topics()
+    else:
+        exporter.reset()
+        finished = set()
+    pending = [topic_id for topic_id in topics if topic_id not in finished]
+    print(f"{len(finished)} topics already finished, {len(pending)} to go")
+
+    failed = {}
+    start = time.perf_counter()
+    rerank_pool = ProcessPoolExecutor(max_workers=rerank_workers) if rerank_workers > 0 else None
+    pool = ThreadPoolExecutor(max_workers=concurrency)
+    interrupted = False
+    try:
+        futures = {
+            pool.submit(process_topic, weaviate_db, topics[topic_id], depth, top_n, exporter.strategies, rerank_pool): topic_id
+            for topic_id in pending
+        }
+        for done, future in enumerate(as_completed(futures), start=1):
+            topic_id = futures[future]
+            try:
+                rankings, segment_ids, documents, query_similarities = future.result()
+            except Exception as e:
+                failed[topic_id] = str(e)
+                print(f"\nTopic {topic_id} failed: {e}")
+            else:
+                exporter.add(topic_id, topics[topic_id], rankings, segment_ids, documents, query_similarities)
+
+            elapsed = time.perf_counter() - start
+            print(f"[{done}/{len(pending)}] {done / elapsed:.2f} topics/s, {len(failed)} failed", end='\r', flush=True)
+    except BaseException:
+        interrupted = True
+        raise
+    finally:
+        # on an interrupt the queued topics are dropped instead of retrieved and thrown away,
+        # only the running ones finish, --resume picks up the rest
+        pool.shutdown(wait=not interrupted, cancel_futures=interrupted)
+        # whatever finished is written, also when the run is interrupted
+        exporter.flush()
+        if rerank_pool is not None:
+            rerank_pool.shutdown(wait=not interrupted, cancel_futures=interrupted)
+    print()
+
+    if failed:
+        print(f"{len(failed)} topics failed, rerun with --resume to retry them: {', '.join(failed)}")
+    return failed
+
 
 '''print("No reranking \n")
 
@@ -113,7 +282,52 @@ for id in selected_indices_db:
     print(query_similarities[id])
 
 
+from visualization import visualize_rankings_with_tsne
 visualize_rankings_with_tsne(topic, top_vectors, selected_indices_mmr, selected_indices_dr, selected_indices_db)'''
 
 
-client.close()
\ No newline at end of file
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Retrieve and rerank the documents of every topic")
+    parser.add_argument("--topics", nargs="+", default=DEFAULT_TOPICS_FILES, help="topic files, the first one wins for duplicate ids")
+    parser.add_argument("--output", default="reranked_docs", help="base name of the files in ./output")
+    parser.add_argument("--depth", type=int, default=20, help="number of documents retrieved per topic")
+    parser.add_argument("--top-n", type=int, default=5, help="number of documents kept by every strategy")
+    parser.add_argument("--concurrency", type=int, default=8, help="number of topics retrieved at the same time")
+    parser.add_argument("--rerank-workers", type=int, default=os.cpu_count(), help="reranking processes, 0 reranks in the retrieval threads")
+    parser.add_argument("--limit", type=int, default=None, help="only process the first n topics")
+    parser.add_argument("--resume", action="store_true", help="skip the topics finished by an earlier run")
+    parser.add_argument("--strategies", default=",".join(STRATEGIES), help=f"comma separated strategies to export, from {', '.join(STRATEGIES)}")
+    parser.add_argument("--compression", choices=["gzip", "zstd"], default=None)
+    parser.add_argument("--snapshot", default=None, help="rerank from a local snapshot directory instead of Weaviate")
+    parser.add_argument("--local-index", default=None, help="search a local segment index instead of Weaviate")
+    parser.add_argument("--nprobe", type=int, default=8, help="number of IVF cells searched with --local-index")
+    parser.add_argument("--flush-every", type=int, default=10, help="number of topics buffered before writing")
+    args = parser.parse_args()
+
+    strategy_names = args.strategies.split(",")
+    unknown = [name for name in strategy_names if name not in STRATEGIES]
+    if unknown:
+        parser.error(f"unknown strategies: {', '.join(unknown)}")
+
+    topics = TopicRegistry(args.topics).as_dict(args.limit)
+
+    exporter = StreamingExporter(args.output, strategy_names, args.compression, args.flush_every)
+    if args.resume:
+        try:
+            exporter.check_format()
+        except ValueError as e:
+            parser.error(str(e))
+
+    # set CACHE_QUERY_EMBEDDINGS to embed queries through the cached embedding service instead of Weaviate's vectorizer
+    if args.snapshot is not None:
+        weaviate_db = weaviate_custom_offline(args.snapshot)
+    elif args.local_index is not None:
+        weaviate_db = weaviate_custom_local(args.local_index, nprobe=args.nprobe)
+    else:
+        weaviate_db = weaviate_custom(query_vectorizer=cached_vectorize if os.environ.get("CACHE_QUERY_EMBEDDINGS") else None)
+    weaviate_db.db_connect()
+    try:
+        run(topics, weaviate_db, exporter, args.depth, args.top_n, args.concurrency, args.rerank_workers, args.resume)
+    finally:
+        weaviate_db.db_disconnect()
+        flush_query_cache()
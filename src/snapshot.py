@@ -0,0 +1,134 @@
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import argparse
+import json
+import os
+import shutil
+import time
+import numpy as np
+
+
+class SnapshotStore:
+    """
+    Read-only local store of every topic's retrieved candidates.
+
+    A snapshot directory holds
+    - vectors.npy: float32 matrix of all candidate vectors, memory-mapped on load
+    - segments.jsonl: one line per matrix row with the segment id, text and certainty
+    - index.json: per topic the first row, the number of rows and the byte
+      offset of its first line in segments.jsonl
+
+    Candidates of a topic are stored in retrieval order, so the first top_n
+    rows are the top_n result of the original query.
+    """
+    def __init__(self, path):
+        self.path = path
+        with open(os.path.join(path, "index.json"), "r") as f:
+            meta = json.load(f)
+        self.depth = meta["depth"]
+        self.topics = meta["topics"]
+        self.vectors = np.load(os.path.join(path, "vectors.npy"), mmap_mode="r")
+
+    def __contains__(self, query):
+        return query in self.topics
+
+    def retrieve(self, query, top_n, with_ids=False):
+        if query not in self.topics:
+            raise KeyError(f"Topic not in snapshot {self.path}: {query}")
+        entry = self.topics[query]
+        count = min(top_n, entry["count"])
+
+        records = []
+        with open(os.path.join(self.path, "segments.jsonl"), "rb") as f:
+            f.seek(entry["text_offset"])
+            for _ in range(count):
+                records.append(json.loads(f.readline()))
+
+        top_documents = [record["segment"] for record in records]
+        query_similarities = [record["certainty"] for record in records]
+        # a view on the memory map, no copy
+        top_vectors = self.vectors[entry["row"]:entry["row"] + count]
+
+        if with_ids:
+            return top_documents, top_vectors, query_similarities, [record["id"] for record in records]
+        return top_documents, top_vectors, query_similarities
+
+
+def write_snapshot(path, topics, weaviate_db, depth=20, concurrency=8):
+    """
+    Retrieve the top depth candidates of every topic and store them in a snapshot directory.
+
+    Args:
+    - path (str): Snapshot directory, created if missing.
+    - topics (dict): Topic id mapped to the topic text.
+    - weaviate_db (weaviate_custom): Connected retrieval backend.
+    - depth (int): Number of candidates stored per topic.
+    - concurrency (int): Number of topics retrieved at the same time.
+
+    Returns:
+    - dict: Topic id mapped to the error of every topic that failed.
+    """
+    os.makedirs(path, exist_ok=True)
+    raw_vectors_path = os.path.join(path, "vectors.tmp")
+    index = {}
+    failed = {}
+    row = 0
+    dim = None
+    start = time.perf_counter()
+
+    with open(raw_vectors_path, "wb") as vectors_f, open(os.path.join(path, "segments.jsonl"), "wb") as segments_f, \
+            ThreadPoolExecutor(max_workers=concurrency) as pool:
+        futures = {pool.submit(weaviate_db.retrieve, topics[topic_id], depth, True): topic_id for topic_id in topics}
+        for done, future in enumerate(as_completed(futures), start=1):
+            topic_id = futures[future]
+            try:
+                top_documents, top_vectors, query_similarities, segment_ids = future.result()
+            except Exception as e:
+                failed[topic_id] = str(e)
+                print(f"\nTopic {topic_id} failed: {e}")
+                continue
+
+            top_vectors = np.ascontiguousarray(top_vectors, dtype=np.float32)
+            if len(top_vectors):
+                dim = top_vectors.shape[1] if dim is None else dim
+            index[topics[topic_id]] = {"topic_id": topic_id, "row": row, "count": len(top_documents), "text_offset": segments_f.tell()}
+            vectors_f.write(top_vectors.tobytes())
+            segments_f.write("".join(
+                json.dumps({"id": segment_id, "segment": document, "certainty": certainty}) + "\n"
+                for segment_id, document, certainty in zip(segment_ids, top_documents, query_similarities)
+            ).encode("utf-8"))
+            row += len(top_documents)
+            print(f"[{done}/{len(topics)}] {done / (time.perf_counter() - start):.2f} topics/s", end="\r", flush=True)
+    print()
+
+    # prepend the .npy header to the raw rows so the matrix can be memory-mapped
+    with open(os.path.join(path, "vectors.npy"), "wb") as f, open(raw_vectors_path, "rb") as raw:
+        header = {"descr": "<f4", "fortran_order": False, "shape": (row, dim or 0)}
+        np.lib.format.write_array_header_1_0(f, header)
+        shutil.copyfileobj(raw, f)
+    os.remove(raw_vectors_path)
+
+    with open(os.path.join(path, "index.json"), "w") as f:
+        json.dump({"depth": depth, "dim": dim, "topics": index}, f)
+
+    return failed
+
+
+if __name__ == "__main__":
+    from weaviate_custom import weaviate_custom
+    from topics import TopicRegistry, DEFAULT_TOPICS_FILES
+
+    parser = argparse.ArgumentParser(description="Store every topic's retrieved candidates in a local snapshot")
+    parser.add_argument("--topics", nargs="+", default=DEFAULT_TOPICS_FILES, help="topic files, the first one wins for duplicate ids")
+    parser.add_argument("--output", default="./snapshots/rag24", help="snapshot directory")
+    parser.add_argument("--depth", type=int, default=20, help="number of candidates stored per topic")
+    parser.add_argument("--concurrency", type=int, default=8, help="number of topics retrieved at the same time")
+    args = parser.parse_args()
+
+    weaviate_db = weaviate_custom()
+    weaviate_db.db_connect()
+    try:
+        failed = write_snapshot(args.output, TopicRegistry(args.topics).as_dict(), weaviate_db, args.depth, args.concurrency)
+    finally:
+        weaviate_db.db_disconnect()
+    if failed:
+        print(f"{len(failed)} topics failed and are missing from the snapshot: {', '.join(failed)}")
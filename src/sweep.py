@@ -0,0 +1,59 @@
+import argparse
+import json
+import time
+import numpy as np
+from snapshot import SnapshotStore
+from topics import TopicRegistry, DEFAULT_TOPICS_FILES
+from utilities import stack_candidates, rerank_grid, parameter_grid
+
+# Parameter sweep of the reranking strategies over every topic of a snapshot,
+# without retrieving anything again:
+#
+#   python sweep.py --snapshot ./snapshots/rag24 --lambdas 0.1,0.3,0.5,0.7,0.9 --sigmas 0.05,0.096,0.15 --top-n 5,10
+
+
+def parse_ints(value):
+    return [int(x) for x in value.split(",") if x]
+
+
+def parse_floats(value):
+    return [float(x) for x in value.split(",") if x]
+
+
+def load_candidates(store, topics, depth):
+    # stacked candidates of the topics found in the snapshot
+    topic_ids, vectors_list, query_similarities_list = [], [], []
+    for topic_id, topic in topics.items():
+        if topic not in store:
+            continue
+        _, top_vectors, query_similarities = store.retrieve(topic, depth)
+        topic_ids.append(topic_id)
+        vectors_list.append(top_vectors)
+        query_similarities_list.append(query_similarities)
+    vectors, query_similarities, sizes = stack_candidates(vectors_list, query_similarities_list)
+    return topic_ids, vectors, query_similarities, sizes
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Rerank every snapshot topic for a grid of strategy settings")
+    parser.add_argument("--topics", nargs="+", default=DEFAULT_TOPICS_FILES, help="topic files, the first one wins for duplicate ids")
+    parser.add_argument("--snapshot", default="./snapshots/rag24", help="snapshot directory with the candidates")
+    parser.add_argument("--output", default="./output/sweep.npz", help="result file")
+    parser.add_argument("--depth", type=int, default=20, help="number of candidates reranked per topic")
+    parser.add_argument("--top-n", type=parse_ints, default=[5], help="comma separated top_n values")
+    parser.add_argument("--lambdas", type=parse_floats, default=[0.3], help="comma separated MMR lambdas")
+    parser.add_argument("--sigmas", type=parse_floats, default=[0.096], help="comma separated Dartboard sigmas")
+    parser.add_argument("--no-dr", action="store_true", help="leave the diversity ranker out of the grid")
+    args = parser.parse_args()
+
+    store = SnapshotStore(args.snapshot)
+    topic_ids, vectors, query_similarities, sizes = load_candidates(store, TopicRegistry(args.topics).as_dict(), args.depth)
+    grid = parameter_grid(args.top_n, args.lambdas, args.sigmas, not args.no_dr)
+
+    start = time.perf_counter()
+    indices = rerank_grid(vectors, query_similarities, grid, sizes)
+    print(f"Reranked {len(topic_ids)} topics for {len(grid)} settings in {time.perf_counter() - start:.2f}s")
+
+    # indices[t, s] are the documents topic_ids[t] keeps under grid[s], -1 padded
+    np.savez_compressed(args.output, indices=indices, topic_ids=np.array(topic_ids), grid=json.dumps(grid))
+    print(f"Wrote {args.output}")
@@ -0,0 +1,80 @@
+from html import escape
+import os
+import threading
+
+# Topic files used when none are given, TOPICS_FILES holds several paths separated by os.pathsep
+DEFAULT_TOPICS_FILES = os.environ.get("TOPICS_FILES", "./Topics/topics.rag24.test.txt").split(os.pathsep)
+
+
+def parse_topics_file(topics_file_path):
+    # tab separated "<topic id>\t<topic text>" lines, anything else is skipped
+    with open(topics_file_path, 'r') as file:
+        for line in file:
+            parts = line.strip().split('\t')
+            if len(parts) == 2:
+                yield parts[0], parts[1]
+
+
+class TopicRegistry:
+    """
+    Topics of one or more topic files, read on first use.
+
+    Lookups by topic id and by topic text are dictionary lookups. When an id
+    appears in several files the first occurrence wins. The dropdown options
+    of the topic selector are rendered once and reused.
+
+    Args:
+    - paths (list): Topic files, in priority order.
+    """
+    def __init__(self, paths=None):
+        self.paths = list(DEFAULT_TOPICS_FILES if paths is None else paths)
+        self.lock = threading.Lock()
+        self.by_id = None
+        self.by_text = None
+        self.options_html = None
+
+    def load(self):
+        if self.by_id is None:
+            with self.lock:
+                if self.by_id is None:
+                    by_id, by_text = {}, {}
+                    for path in self.paths:
+                        for topic_id, text in parse_topics_file(path):
+                            if topic_id not in by_id:
+                                by_id[topic_id] = text
+                                by_text.setdefault(text, topic_id)
+                    self.by_text = by_text
+                    self.by_id = by_id
+        return self
+
+    def __contains__(self, text):
+        return text in self.load().by_text
+
+    def __len__(self):
+        return len(self.load().by_id)
+
+    def get(self, topic_id, default=None):
+        return self.load().by_id.get(topic_id, default)
+
+    def id_of(self, text):
+        return self.load().by_text.get(text)
+
+    def texts(self):
+        return list(self.load().by_id.values())
+
+    def as_dict(self, limit=None):
+        # topic id mapped to topic text, optionally only the first limit topics
+        items = self.load().by_id.items()
+        if limit is not None:
+            items = list(items)[:limit]
+        return dict(items)
+
+    def dropdown_options(self):
+        # <option> elements of every topic, the same for every page so they are rendered once
+        if self.options_html is None:
+            self.options_html = "".join([f'<option value="{escape(text)}">{escape(text)}</option>' for text in self.texts()])
+        return self.options_html
+
+
+# Registry of the default topic files, shared by everything in the process
+registry = TopicRegistry()
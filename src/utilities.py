@@ -1,14 +1,53 @@
-from sklearn.metrics.pairwise import cosine_similarity
+from functools import partial
 import numpy as np
+from embedding_codec import QuantizedEmbeddings
 
-def similarity_matrix_calculator(vectors):
 
-    X = np.array(vectors)
-    similarity_matrix = cosine_similarity(X)
+class RerankContext:
+    """
+    Normalized float32 embeddings of one query's candidates and their cosine
+    similarity (Gram) matrix, computed once and shared by every reranker.
 
-    return similarity_matrix
+    Parameters:
+    vectors : array-like or QuantizedEmbeddings
+        nxd document embeddings, relevance sorted. Quantized embeddings are
+        kept as they are and the Gram matrix is computed from them.
+    query_similarities : array-like, optional
+        Cosine similarities between the query and the documents.
+    """
+    def __init__(self, vectors, query_similarities=None):
+        self.query_similarities = None if query_similarities is None else np.asarray(query_similarities, dtype=np.float64)
+        if isinstance(vectors, QuantizedEmbeddings):
+            self.embeddings = vectors
+            self.similarity_matrix = vectors.gram()
+            return
+
+        X = np.array(vectors, dtype=np.float32, ndmin=2)
+        norms = np.linalg.norm(X, axis=1)
+        # MiniLM vectors are usually unit-norm already, then the Gram matrix is a plain dot product
+        if not np.allclose(norms, 1, atol=1e-4):
+            norms[norms == 0] = 1
+            X /= norms[:, None]
+
+        self.embeddings = np.ascontiguousarray(X)
+        self.similarity_matrix = self.embeddings @ self.embeddings.T
+
+    def __len__(self):
+        return len(self.embeddings)
+
+
+def as_context(vectors, query_similarities=None, require_query_similarities=False):
+    # rerankers accept either a prepared RerankContext or raw vectors
+    context = vectors if isinstance(vectors, RerankContext) else RerankContext(vectors, query_similarities)
+    if require_query_similarities and context.query_similarities is None:
+        raise ValueError("query_similarities are required, pass them or a RerankContext built with them")
+    return context
+
+
+def similarity_matrix_calculator(vectors):
+
+    return as_context(vectors).similarity_matrix
 
-import numpy as np
 
 # Function to calculate the natural log of Gaussian PDF
 def LogNorm(arr, sigma):
@@ -23,83 +62,205 @@ def LogNorm(arr, sigma):
         
     Returns:
     numpy array
-        The transformed array after applying the log of Gaussian PDF.
+        The transformed array after applying the log of Gaussian PDF, in the
+        dtype of arr.
     """
-    ln_2pi = np.log(2 * np.pi)
-    term1 = np.log(sigma)
-    term2 = -0.5 * ln_2pi
-    term3 = -0.5 * (arr ** 2) / (sigma ** 2)
-    
-    return term1 + term2 + term3
+    arr = np.asarray(arr)
+    return scale_lognorm(-0.5 * arr ** 2, sigma)
 
 
-def MMR(vectors, query_similarities ,lambda_param=0.5, top_n=5):
-    # smaller the lambda value higher diversity there is
-    similarity_matrix = similarity_matrix_calculator(vectors)
-    
-    selected_indices = []
-    candidate_indices = list(range(len(vectors)))
+def lognorm_coefficients(sigma):
+    # LogNorm(x, sigma) == -0.5 * x**2 * scale + offset, as float64 scalars
+    sigma = np.float64(sigma)
+    return 1 / sigma ** 2, np.log(sigma) - 0.5 * np.log(2 * np.pi)
+
+
+def scale_lognorm(half_squares, sigma):
+    # LogNorm from precomputed -0.5 * arr**2, so several sigmas can share the squares
+    scale, offset = lognorm_coefficients(sigma)
+    dtype = half_squares.dtype.type
+    return half_squares * dtype(scale) + dtype(offset)
+
+
+def mmr_select(similarity_matrices, query_similarities, lambda_param=0.5, top_n=5, matrix_rows=None):
+    """
+    Greedy MMR selection for a batch of queries in one vectorized pass.
+
+    Parameters:
+    similarity_matrices : numpy array
+        (b, n, n) document similarity matrices, zero padded for shorter queries.
+    query_similarities : numpy array
+        (b, n) query similarities, NaN where a query has fewer than n candidates.
+    lambda_param : float or numpy array
+        Trade-off between relevance and diversity, or one value per query.
+    top_n : int
+        Number of documents to select per query.
+    matrix_rows : numpy array, optional
+        (b,) index of the similarity matrix of every query, so several queries
+        (e.g. one topic with different lambdas) can share one matrix.
+
+    Returns:
+    numpy array
+        (b, top_n) selected indices. Rows of queries with fewer than top_n
+        candidates are only valid up to their candidate count.
+    """
+    batch_size, n = query_similarities.shape
+    rows = np.arange(batch_size)
+    matrix_rows = rows if matrix_rows is None else matrix_rows
+    lambda_param = np.asarray(lambda_param, dtype=np.float64)
+    if lambda_param.ndim:
+        lambda_param = lambda_param[:, None]
+    available = ~np.isnan(query_similarities)
+    relevance = lambda_param * np.where(available, query_similarities, 0)
+
+    # running max similarity of every candidate to the selected set
+    max_similarity = np.full((batch_size, n), -np.inf)
+    selected_indices = np.zeros((batch_size, top_n), dtype=np.int64)
+
+    for step in range(min(top_n, n)):
+        # no selected documents yet, so no diversity penalty on the first pick
+        diversity = max_similarity if step else 0
+        mmr_scores = np.where(available, relevance - (1 - lambda_param) * diversity, -np.inf)
+        selected = np.argmax(mmr_scores, axis=1)
+        selected_indices[:, step] = selected
+        available[rows, selected] = False
+        np.maximum(max_similarity, similarity_matrices[matrix_rows, :, selected], out=max_similarity)
 
-    for _ in range(top_n):
-        mmr_score = []
-        
-        for candidate in candidate_indices:
-            relevance = query_similarities[candidate]
-            
-            # Diversity term: similarity to already selected documents
-            if selected_indices:
-                diversity = max([similarity_matrix[candidate, selected] for selected in selected_indices])
-            else:
-                diversity = 0  # No selected documents yet, so no diversity penalty
-            
-            # MMR score: lambda * relevance - (1 - lambda) * diversity
-            mmr = lambda_param * relevance - (1 - lambda_param) * diversity
-            mmr_score.append((candidate, mmr))
-        
-        # Select the document with the highest MMR score
-        selected = max(mmr_score, key=lambda x: x[1])[0]
-        selected_indices.append(selected)
-        candidate_indices.remove(selected)
-    
     return selected_indices
 
 
+def MMR(vectors, query_similarities=None, lambda_param=0.5, top_n=5):
+    # smaller the lambda value higher diversity there is
+    context = as_context(vectors, query_similarities, require_query_similarities=True)
+    top_n = min(top_n, len(context))
+
+    selected_indices = mmr_select(context.similarity_matrix[None], context.query_similarities[None], lambda_param, top_n)
+    return selected_indices[0].tolist()
+
+
+def MMR_batch(vectors_batch, query_similarities_batch=None, lambda_param=0.5, top_n=5):
+    """
+    Run MMR for several queries at once, each with its own candidate vectors
+    or RerankContext.
+
+    Returns:
+    list
+        One list of selected indices per query.
+    """
+    if query_similarities_batch is None:
+        query_similarities_batch = [None] * len(vectors_batch)
+    contexts = [as_context(vectors, sims, require_query_similarities=True) for vectors, sims in zip(vectors_batch, query_similarities_batch)]
+    sizes = [len(context) for context in contexts]
+    n = max(sizes, default=0)
+    similarity_matrices = np.zeros((len(sizes), n, n), dtype=np.float32)
+    query_similarities = np.full((len(sizes), n), np.nan)
+    for b, context in enumerate(contexts):
+        similarity_matrices[b, :sizes[b], :sizes[b]] = context.similarity_matrix
+        query_similarities[b, :sizes[b]] = context.query_similarities
+
+    selected_indices = mmr_select(similarity_matrices, query_similarities, lambda_param, min(top_n, n))
+    return [selected_indices[b, :min(top_n, size)].tolist() for b, size in enumerate(sizes)]
+
+
 
 def diversity_ranker(doc_vectors, top_n=5):
     
-    similarity_matrix = similarity_matrix_calculator(doc_vectors)
+    similarity_matrix = as_context(doc_vectors).similarity_matrix
+    n = len(similarity_matrix)
     
     # the vectors are already relevance sorted
     first_selected_idx = 0
     ranked_docs = [first_selected_idx]
     
     # Track remaining documents that haven't been selected
-    remaining_indices = set(range(len(doc_vectors))) - {first_selected_idx}
+    remaining = np.ones(n, dtype=bool)
+    remaining[first_selected_idx] = False
+
+    # Running sum of similarities of every document to the selected documents
+    similarity_sums = similarity_matrix[:, first_selected_idx].astype(np.float64)
     
-    # Step 3: Iteratively select documents based on average similarity to selected documents
-    while remaining_indices:
-        avg_similarities = []
-        
-        # Calculate the average similarity of each remaining document to the already selected documents
-        for idx in remaining_indices:
-            # Get the similarities of the current document to all selected documents
-            selected_sims = similarity_matrix[idx, ranked_docs]
-            
-            # Compute average similarity to selected documents
-            avg_similarity = np.mean(selected_sims)
-            avg_similarities.append((idx, avg_similarity))
-        
-        # Step 4: Select the document with the lowest average similarity
-        next_selected_idx = min(avg_similarities, key=lambda x: x[1])[0]
+    # Iteratively select the document with the lowest average similarity to the selected ones,
+    # stopping as soon as top_n documents are ranked
+    while len(ranked_docs) < min(top_n, n):
+        avg_similarities = np.where(remaining, similarity_sums / len(ranked_docs), np.inf)
+        next_selected_idx = int(np.argmin(avg_similarities))
         ranked_docs.append(next_selected_idx)
         
-        # Update remaining documents
-        remaining_indices.remove(next_selected_idx)
+        # Update remaining documents and the running sums
+        remaining[next_selected_idx] = False
+        similarity_sums += similarity_matrix[:, next_selected_idx]
     
-    return ranked_docs[:top_n]
+    return ranked_docs
+
+def logsumexp_rows(arr):
+    # numerically stable log(sum(exp(arr))) over the last axis
+    row_max = arr.max(axis=-1, keepdims=True)
+    return row_max[..., 0] + np.log(np.sum(np.exp(arr - row_max), axis=-1))
+
+
+def lognorm_rows(D, start, end, sigma):
+    # float64 LogNorm of rows start:end of D, the same operations as LogNorm of a float64 array
+    rows = D[start:end].astype(np.float64)
+    np.square(rows, out=rows)
+    rows *= -0.5
+    return scale_lognorm(rows, sigma)
+
+
+def dartboard_select(D, Q, sigma, top_n=5, chunk_size=128):
+    """
+    Greedy Dartboard search on the similarities.
+
+    The LogNorm transform is computed chunk_size candidate rows at a time,
+    in float64 since the late picks are near ties that float32 rounding can
+    flip. Besides D only chunk_size x n temporaries are held, so the float32
+    similarity matrix is never copied as a whole. Already selected documents
+    are masked out and can't be picked twice.
+
+    Parameters:
+    D : numpy array
+        nxn document similarity matrix.
+    Q : numpy array
+        Query similarities.
+    sigma : float
+        The standard deviation of the Gaussians.
+    top_n : int
+        Number of documents to return.
+    chunk_size : int
+        Number of candidate rows scored at once.
+
+    Returns:
+    list
+        List of indices of the top_n selected documents.
+    """
+    n = len(Q)
+    Q_ln = LogNorm(np.asarray(Q, dtype=np.float64), sigma)
+    scores = np.empty(n)
+    selected = np.zeros(n, dtype=bool)
+
+    # the docs are relevance ranked
+    m = 0
+    maxes = lognorm_rows(D, m, m + 1, sigma)[0]
+    ret = [m]
+    selected[m] = True
+
+    while len(ret) < min(top_n, n):
+        for start in range(0, n, chunk_size):
+            newmax = lognorm_rows(D, start, start + chunk_size, sigma)
+            np.maximum(maxes, newmax, out=newmax)
+            newmax += Q_ln
+            scores[start:start + chunk_size] = logsumexp_rows(newmax)
+        scores[selected] = -np.inf
+
+        m = int(np.argmax(scores))
+        np.maximum(maxes, lognorm_rows(D, m, m + 1, sigma)[0], out=maxes)
+        ret.append(m)
+        selected[m] = True
+
+    return ret
+
 
 # Function to perform the Dartboard algorithm
-def dartboard(doc_vectors, query_similarities, top_n = 5, sigma =  0.096):
+def dartboard(doc_vectors, query_similarities=None, top_n = 5, sigma =  0.096, chunk_size=128):
     """
     Greedily seed and search for the most relevant k points based on similarity.
     
@@ -112,31 +273,278 @@ def dartboard(doc_vectors, query_similarities, top_n = 5, sigma =  0.096):
         Number of documents to return.
     sigma : float
         The standard deviation of the Gaussians (a measure of spread).
+    chunk_size : int
+        Number of candidate rows scored at once, bounds the peak memory.
         
     Returns:
     list
         List of indices of the top k selected documents.
     """
-    query_similarities = np.array(query_similarities)
-    D = similarity_matrix_calculator(doc_vectors)
-    # Step 1: Apply LogNorm transformation to D and Q
-    D_ln = LogNorm(D, sigma)
-    Q_ln = LogNorm(query_similarities, sigma)
-    
-    # Step 2: Greedily seed and search
-    # the docs are relevance ranked
-    m = 0
-    maxes = D_ln[m]  
-    ret = [m]  # Initialize return list with index m
-    
-    # Step 3: Incrementally add until we have k elements
-    while len(ret) < top_n:
-        # Find the new maximum for the selected document
-        newmax = np.maximum(maxes, D_ln)  # Element-wise maximum of maxes and D
-        scores = np.log(np.sum(np.exp(newmax + Q_ln), axis=1))  # LogSumExp calculation
-        
-        m = np.argmax(scores)  # Get index of max score
-        maxes = newmax[m]  # Update maxes with the row corresponding to m
-        ret.append(m)  # Append the new index to the return list
-    
-    return ret
+    context = as_context(doc_vectors, query_similarities, require_query_similarities=True)
+    # LogNorm transformation of D and Q, applied per chunk
+    return dartboard_select(context.similarity_matrix, context.query_similarities, sigma, top_n, chunk_size)
+
+
+def dartboard_sweep(doc_vectors, query_similarities=None, settings=(), chunk_size=128):
+    """
+    Run Dartboard for several (sigma, top_n) settings on the same documents.
+
+    The similarity matrix is computed once and shared by every sigma. Settings
+    sharing a sigma are served by a single greedy run, since the selection for
+    a smaller top_n is a prefix of the one for a larger top_n.
+
+    Returns:
+    list
+        List of selected indices for each setting, in the order given.
+    """
+    context = as_context(doc_vectors, query_similarities, require_query_similarities=True)
+
+    longest = {}
+    for sigma, top_n in settings:
+        longest[sigma] = max(top_n, longest.get(sigma, 0))
+
+    runs = {}
+    for sigma, top_n in longest.items():
+        runs[sigma] = dartboard_select(context.similarity_matrix, context.query_similarities, sigma, top_n, chunk_size)
+
+    return [runs[sigma][:top_n] for sigma, top_n in settings]
+
+
+# Reranking strategies by name, each called as strategy(context, top_n=top_n)
+STRATEGIES = {
+    "mmr": partial(MMR, lambda_param=0.3),
+    "dr": diversity_ranker,
+    "db": dartboard,
+}
+
+
+def strategies_signature(strategies=None):
+    # hashable description of the configured strategies and their parameters, used in cache keys
+    strategies = STRATEGIES if strategies is None else strategies
+    signature = []
+    for name, strategy in strategies.items():
+        params = tuple(sorted(getattr(strategy, "keywords", {}).items()))
+        function = getattr(strategy, "func", strategy)
+        signature.append((name, function.__name__, params))
+    return tuple(signature)
+
+
+def rerank_indices(context, top_n=5, strategies=None):
+    """
+    Run every configured strategy on one shared RerankContext.
+
+    Returns:
+    dict
+        Strategy name mapped to the list of selected indices.
+    """
+    strategies = STRATEGIES if strategies is None else strategies
+    return {name: strategy(context, top_n=top_n) for name, strategy in strategies.items()}
+
+
+def stack_candidates(vectors_list, query_similarities_list):
+    """
+    Pad per-topic candidates into one (topics, n, d) tensor.
+
+    Returns:
+    tuple
+        The zero padded float32 vectors, the NaN padded (topics, n) query
+        similarities and the number of candidates of every topic.
+    """
+    sizes = np.array([len(vectors) for vectors in vectors_list])
+    n = sizes.max(initial=0)
+    dim = max((np.shape(vectors)[1] for vectors in vectors_list if len(vectors)), default=0)
+    vectors = np.zeros((len(sizes), n, dim), dtype=np.float32)
+    query_similarities = np.full((len(sizes), n), np.nan)
+    for t, size in enumerate(sizes):
+        vectors[t, :size] = vectors_list[t]
+        query_similarities[t, :size] = query_similarities_list[t]
+    return vectors, query_similarities, sizes
+
+
+def batch_similarity_matrices(vectors, sizes):
+    # RerankContext Gram matrix of every topic of a (topics, n, d) tensor, padding rows stay zero
+    n = vectors.shape[1]
+    similarity_matrices = np.zeros((len(sizes), n, n), dtype=np.float32)
+    for t, size in enumerate(sizes):
+        if size:
+            similarity_matrices[t, :size, :size] = RerankContext(vectors[t, :size]).similarity_matrix
+    return similarity_matrices
+
+
+def diversity_select(similarity_matrices, available, top_n=5):
+    """
+    Batched diversity_ranker: every query starts from its first document and
+    adds the one with the lowest summed similarity to the selected ones.
+
+    Returns:
+    numpy array
+        (b, top_n) selected indices, -1 past a query's candidate count.
+    """
+    batch_size, n = available.shape
+    rows = np.arange(batch_size)
+    available = available.copy()
+    selected_indices = np.full((batch_size, top_n), -1, dtype=np.int64)
+    if not n or not top_n:
+        return selected_indices
+
+    selected_indices[:, 0] = np.where(available[:, 0], 0, -1)
+    available[:, 0] = False
+    similarity_sums = similarity_matrices[:, :, 0].astype(np.float64)
+    for step in range(1, min(top_n, n)):
+        scores = np.where(available, similarity_sums, np.inf)
+        selected = np.argmin(scores, axis=1)
+        valid = available[rows, selected]
+        selected_indices[:, step] = np.where(valid, selected, -1)
+        available[rows, selected] = False
+        similarity_sums += similarity_matrices[rows, :, selected]
+    return selected_indices
+
+
+def dartboard_select_batch(D_sq, Q_sq, available, sigmas, matrix_rows, top_n=5, chunk_elements=2**24):
+    """
+    Batched dartboard_select for several (query, sigma) pairs.
+
+    The LogNorm transforms are rebuilt per chunk from the sigma independent
+    squared terms with the expression of scale_lognorm, chunks hold at most
+    chunk_elements scores. Queries without padding get exactly the selection
+    of dartboard.
+
+    Parameters:
+    D_sq, Q_sq : numpy array
+        float64 -0.5 * D**2 per topic (topics, n, n) and -0.5 * Q**2 per query (b, n).
+    available : numpy array
+        (b, n) mask of the real (not padded) candidates.
+    sigmas : numpy array
+        (b,) sigma of every query.
+    matrix_rows : numpy array
+        (b,) topic of every query in D_sq.
+
+    Returns:
+    numpy array
+        (b, top_n) selected indices, -1 past a query's candidate count.
+    """
+    batch_size, n = Q_sq.shape
+    selected_indices = np.full((batch_size, top_n), -1, dtype=np.int64)
+    if not n or not top_n:
+        return selected_indices
+    chunk = max(1, chunk_elements // (n * n))
+    coefficients = {sigma: lognorm_coefficients(sigma) for sigma in np.unique(sigmas)}
+    scales = np.array([coefficients[sigma][0] for sigma in sigmas])
+    offsets = np.array([coefficients[sigma][1] for sigma in sigmas])
+
+    for start in range(0, batch_size, chunk):
+        end = min(start + chunk, batch_size)
+        rows = np.arange(end - start)
+        scale = scales[start:end, None]
+        offset = offsets[start:end, None]
+        D_ln = D_sq[matrix_rows[start:end]] * scale[:, :, None] + offset[:, :, None]
+        # padded candidates get -inf and drop out of the log-sum-exp
+        Q_ln = np.where(available[start:end], Q_sq[start:end] * scale + offset, -np.inf)
+        taken = ~available[start:end]
+
+        # the docs are relevance ranked
+        selected_indices[start:end, 0] = np.where(taken[:, 0], -1, 0)
+        taken[:, 0] = True
+        maxes = D_ln[:, 0, :].copy()
+        for step in range(1, min(top_n, n)):
+            newmax = np.maximum(maxes[:, None, :], D_ln)
+            newmax += Q_ln[:, None, :]
+            scores = logsumexp_rows(newmax)
+            scores[taken] = -np.inf
+            selected = np.argmax(scores, axis=1)
+            valid = ~taken[rows, selected]
+            selected_indices[start:end, step] = np.where(valid, selected, -1)
+            taken[rows, selected] = True
+            np.maximum(maxes, D_ln[rows, selected], out=maxes)
+    return selected_indices
+
+
+def rerank_grid(vectors, query_similarities, grid, sizes=None):
+    """
+    Rerank many topics for a grid of strategy settings in one batched pass.
+
+    Every topic's similarity matrix is computed once. Settings of a strategy
+    that only differ in top_n share one greedy run at the largest top_n, since
+    a greedy selection for a smaller top_n is a prefix of the larger one. All
+    topics (and all lambdas or sigmas of a strategy) advance through the
+    greedy steps together, for Dartboard all topics with the same number of
+    candidates, so the log-sum-exp never sees padding. Every setting selects
+    what the per-topic strategy selects for it.
+
+    Parameters:
+    vectors : numpy array
+        (topics, n, d) candidate vectors, zero padded, see stack_candidates.
+    query_similarities : numpy array
+        (topics, n) query similarities, NaN padded.
+    grid : list
+        Settings as dicts with "strategy" ("mmr", "dr" or "db"), "top_n" and
+        "lambda_param" for mmr or "sigma" for db.
+    sizes : numpy array, optional
+        Candidates per topic, derived from the NaN padding when missing.
+
+    Returns:
+    numpy array
+        (topics, settings, max top_n) int32 indices, -1 where a setting
+        selects fewer documents.
+    """
+    query_similarities = np.asarray(query_similarities, dtype=np.float64)
+    num_topics, n = query_similarities.shape
+    sizes = (~np.isnan(query_similarities)).sum(axis=1) if sizes is None else np.asarray(sizes)
+    available = np.arange(n)[None, :] < sizes[:, None]
+    similarity_matrices = batch_similarity_matrices(np.asarray(vectors, dtype=np.float32), sizes)
+    max_top_n = max((setting["top_n"] for setting in grid), default=0)
+    result = np.full((num_topics, len(grid), max_top_n), -1, dtype=np.int32)
+    topics = np.arange(num_topics)
+
+    # group the settings by strategy, then by parameter with the longest top_n of each
+    groups = {}
+    for s, setting in enumerate(grid):
+        param = {"mmr": "lambda_param", "db": "sigma"}.get(setting["strategy"])
+        if setting["strategy"] not in ("mmr", "dr", "db"):
+            raise ValueError(f"Unknown strategy in grid: {setting['strategy']}")
+        value = None if param is None else setting[param]
+        groups.setdefault(setting["strategy"], {}).setdefault(value, []).append(s)
+
+    for strategy, by_value in groups.items():
+        values = list(by_value)
+        top_n = min(n, max(grid[s]["top_n"] for members in by_value.values() for s in members))
+        # one batch row per (parameter value, topic)
+        matrix_rows = np.tile(topics, len(values))
+        if strategy == "mmr":
+            lambdas = np.repeat(values, num_topics)
+            padded = np.where(available, query_similarities, np.nan)[matrix_rows]
+            selected = mmr_select(similarity_matrices, padded, lambdas, top_n, matrix_rows)
+            selected[np.arange(top_n)[None, :] >= available[matrix_rows].sum(axis=1)[:, None]] = -1
+        elif strategy == "dr":
+            selected = diversity_select(similarity_matrices, available, top_n)
+        else:
+            # the float64 squares of dartboard_sweep
+            D_sq = -0.5 * similarity_matrices.astype(np.float64) ** 2
+            Q_sq = -0.5 * np.nan_to_num(query_similarities) ** 2
+            selected = np.full((len(matrix_rows), top_n), -1, dtype=np.int64)
+            for size in np.unique(sizes[sizes > 0]):
+                members = np.flatnonzero(sizes == size)
+                rows = (np.arange(len(values))[:, None] * num_topics + members[None, :]).ravel()
+                group_rows = np.tile(np.arange(len(members)), len(values))
+                sigmas = np.repeat(np.asarray(values, dtype=np.float64), len(members))
+                selected[rows, :min(top_n, size)] = dartboard_select_batch(
+                    D_sq[members, :size, :size], Q_sq[members, :size][group_rows],
+                    np.ones((len(rows), size), dtype=bool), sigmas, group_rows, min(top_n, size))
+
+        for v, value in enumerate(values):
+            block = selected[v * num_topics:(v + 1) * num_topics]
+            for s in by_value[value]:
+                k = min(grid[s]["top_n"], top_n)
+                result[:, s, :k] = block[:, :k]
+    return result
+
+
+def parameter_grid(top_ns=(5,), mmr_lambdas=(0.3,), db_sigmas=(0.096,), diversity_ranker=True):
+    # every combination of top_n with the MMR lambdas, the Dartboard sigmas and the diversity ranker
+    grid = []
+    for top_n in top_ns:
+        grid += [{"strategy": "mmr", "lambda_param": float(value), "top_n": top_n} for value in mmr_lambdas]
+        grid += [{"strategy": "db", "sigma": float(value), "top_n": top_n} for value in db_sigmas]
+        if diversity_ranker:
+            grid.append({"strategy": "dr", "top_n": top_n})
+    return grid
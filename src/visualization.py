@@ -1,181 +1,202 @@
+from concurrent.futures import ProcessPoolExecutor
+import argparse
+import os
 import numpy as np
 from sklearn.manifold import TSNE
 from sklearn.decomposition import PCA
-import matplotlib.pyplot as plt
-import requests
+from matplotlib.figure import Figure
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+from embedding_client import vectorize, vectorize_batch
 
-embedding_url = "http://127.0.0.1:8000/vectorize"
+# Selection bitmask (MMR = 4, DR = 2, DB = 1) mapped to the color category of LEGEND_LABELS
+CATEGORIES = np.array([0, 1, 2, 4, 3, 5, 6, 7])
+LEGEND_LABELS = ['Not selected', 'DB only', 'DR only', 'MMR only', 'DR & DB', 'MMR & DB', 'MMR & DR', 'All three']
+METHOD_NAMES = {"tsne": "t-SNE", "pca": "PCA"}
 
-def visualize_rankings_with_tsne(query, top_vectors, selected_indices_mmr, selected_indices_dr, selected_indices_db, perplexity=5):
+
+def selection_categories(num_vectors, selected_indices_mmr, selected_indices_dr, selected_indices_db):
     """
-    Visualizes document embeddings using t-SNE and colors them based on their selection in different ranking methods.
+    Color category of every document from the strategies that selected it.
 
-    Args:
-    - query (str): The query text to be vectorized and visualized.
-    - top_vectors (array-like): The 384-dimensional embeddings for the documents.
-    - selected_indices_mmr (list): Indices of documents selected by MMR.
-    - selected_indices_dr (list): Indices of documents selected by the Diversity Ranker.
-    - selected_indices_db (list): Indices of documents selected by Dartboard.
-    - perplexity (int): The perplexity parameter for t-SNE (default is 5).
+    Returns:
+    - np.ndarray: One category per document, 7 when selected by all three, 0 when by none.
+    """
+    mask = np.zeros(num_vectors, dtype=np.uint8)
+    mask[np.asarray(selected_indices_mmr, dtype=np.intp)] |= 4
+    mask[np.asarray(selected_indices_dr, dtype=np.intp)] |= 2
+    mask[np.asarray(selected_indices_db, dtype=np.intp)] |= 1
+    return CATEGORIES[mask]
+
+
+def fit_pca(vectors, path=None):
+    """
+    Fit a 2D PCA basis, or load it from path when it was stored before.
+
+    A basis fitted on the vectors of many topics puts every topic in the same
+    coordinates, so it is fitted once and reused for all of them.
 
     Returns:
-    - None: Displays the 2D t-SNE plot with color coding based on ranking selection and query embedding in red.
+    - tuple: The mean and the 2 x d components of the projection.
     """
-    # Convert the selected indices to sets for easier comparison
-    mmr_set = set(selected_indices_mmr)
-    dr_set = set(selected_indices_dr)
-    db_set = set(selected_indices_db)
-
-    # Initialize an array to store the color category for each document
-    num_vectors = len(top_vectors)
-    colors = np.zeros(num_vectors)
-
-    # Assign color codes based on the sets
-    for i in range(num_vectors):
-        in_mmr = i in mmr_set
-        in_dr = i in dr_set
-        in_db = i in db_set
-
-        # Assign a unique number for each combination
-        if in_mmr and in_dr and in_db:
-            colors[i] = 7  # Selected by all three
-        elif in_mmr and in_dr:
-            colors[i] = 6  # Selected by MMR and DR
-        elif in_mmr and in_db:
-            colors[i] = 5  # Selected by MMR and DB
-        elif in_dr and in_db:
-            colors[i] = 4  # Selected by DR and DB
-        elif in_mmr:
-            colors[i] = 3  # Selected only by MMR
-        elif in_dr:
-            colors[i] = 2  # Selected only by DR
-        elif in_db:
-            colors[i] = 1  # Selected only by DB
-        else:
-            colors[i] = 0  # Not selected by any
-
-    # Get the query embedding
-    query_data = {"text": query}
-    response = requests.post(embedding_url, json=query_data)
-    query_embedding = response.json()["embedding"]
-
-    # Append the query_embedding to top_vectors for t-SNE
-    all_vectors = np.vstack([top_vectors, query_embedding])
-
-    # Apply t-SNE to both document embeddings and the query embedding
-    tsne = TSNE(n_components=2, perplexity=perplexity, random_state=42)
-    embeddings_2d = tsne.fit_transform(np.array(all_vectors))
-
-    # Extract the 2D position of the query embedding (last one)
-    query_2d = embeddings_2d[-1]
-
-    # Create a color map
-    colormap = plt.cm.get_cmap('tab10', 8)  # Using a colormap with 8 distinct colors
-
-    # Plot the document embeddings with color coding
-    plt.figure(figsize=(8, 6))
-    scatter = plt.scatter(embeddings_2d[:-1, 0], embeddings_2d[:-1, 1], c=colors, cmap=colormap, s=100)
-
-    # Plot the query embedding separately in red
-    plt.scatter(query_2d[0], query_2d[1], color='red', marker='x', s=200, label="Query")
-
-    # Add text annotations for each point (display the index number)
+    if path is not None and os.path.exists(path):
+        basis = np.load(path)
+        return basis["mean"], basis["components"]
+    pca = PCA(n_components=2).fit(np.asarray(vectors))
+    if path is not None:
+        np.savez(path, mean=pca.mean_, components=pca.components_)
+    return pca.mean_, pca.components_
+
+
+def project(all_vectors, method="pca", pca_basis=None, perplexity=5):
+    # 2D coordinates of the documents and the query (last row)
+    if method == "tsne":
+        tsne = TSNE(n_components=2, perplexity=min(perplexity, len(all_vectors) - 1), random_state=42)
+        return tsne.fit_transform(all_vectors)
+    if pca_basis is None:
+        return PCA(n_components=2).fit_transform(all_vectors)
+    mean, components = pca_basis
+    return (all_vectors - mean) @ components.T
+
+
+def draw_rankings(ax, embeddings_2d, colors, method="pca"):
+    # documents colored by category, numbered by retrieval rank, the query (last row) as a red cross
+    scatter = ax.scatter(embeddings_2d[:-1, 0], embeddings_2d[:-1, 1], c=colors, cmap='tab10', vmin=0, vmax=9, s=100)
+    query_marker = ax.scatter(embeddings_2d[-1, 0], embeddings_2d[-1, 1], color='red', marker='x', s=200)
     for i in range(len(embeddings_2d) - 1):
-        plt.text(embeddings_2d[i, 0], embeddings_2d[i, 1], str(i), fontsize=9, ha='right')
+        ax.text(embeddings_2d[i, 0], embeddings_2d[i, 1], str(i), fontsize=9, ha='right')
 
-    # Create a legend for the color categories
-    legend_labels = ['Not selected', 'DB only', 'DR only', 'MMR only', 'DR & DB', 'MMR & DB', 'MMR & DR', 'All three']
-    plt.legend(handles=scatter.legend_elements()[0], labels=legend_labels, title="Selection")
-    plt.legend(loc="best")
+    present = np.unique(colors)
+    handles = scatter.legend_elements()[0]
+    labels = [LEGEND_LABELS[int(category)] for category in present]
+    ax.legend(handles=list(handles) + [query_marker], labels=labels + ["Query"], title="Selection", loc="best")
 
-    plt.title('t-SNE Visualization of Document Embeddings with Query')
-    plt.xlabel('t-SNE Dimension 1')
-    plt.ylabel('t-SNE Dimension 2')
-    plt.show()
+    name = METHOD_NAMES[method]
+    ax.set_title(f'{name} Visualization of Document Embeddings with Query')
+    ax.set_xlabel(f'{name} Dimension 1')
+    ax.set_ylabel(f'{name} Dimension 2')
 
 
-def visualize_rankings_with_pca(query, top_vectors, selected_indices_mmr, selected_indices_dr, selected_indices_db):
+def visualize_rankings(query, top_vectors, selected_indices_mmr, selected_indices_dr, selected_indices_db,
+                       method="pca", query_embedding=None, output=None, pca_basis=None, perplexity=5):
     """
-    Visualizes document embeddings using PCA and colors them based on their selection in different ranking methods.
+    Visualizes document embeddings in 2D and colors them based on their selection in different ranking methods.
 
     Args:
-    - query (str): The query text to be vectorized and visualized.
+    - query (str): The query text, only embedded when query_embedding is not given.
     - top_vectors (array-like): The 384-dimensional embeddings for the documents.
     - selected_indices_mmr (list): Indices of documents selected by MMR.
     - selected_indices_dr (list): Indices of documents selected by the Diversity Ranker.
     - selected_indices_db (list): Indices of documents selected by Dartboard.
+    - method (str): "pca" or "tsne".
+    - query_embedding (array-like): Precomputed embedding of the query.
+    - output (str): File to write the plot to (.png, .svg, ...), shown interactively when None.
+    - pca_basis (tuple): Mean and components from fit_pca, fitted on this topic alone when None.
+    - perplexity (int): The perplexity parameter for t-SNE.
+    """
+    if query_embedding is None:
+        query_embedding = vectorize(query)
+    top_vectors = np.asarray(top_vectors)
+    colors = selection_categories(len(top_vectors), selected_indices_mmr, selected_indices_dr, selected_indices_db)
+    embeddings_2d = project(np.vstack([top_vectors, query_embedding]), method, pca_basis, perplexity)
 
-    Returns:
-    - None: Displays the 2D PCA plot with color coding based on ranking selection and query embedding in red.
+    if output is None:
+        import matplotlib.pyplot as plt
+        fig, ax = plt.subplots(figsize=(8, 6))
+        draw_rankings(ax, embeddings_2d, colors, method)
+        plt.show()
+        return
+
+    # a bare Figure with the Agg canvas, independent of pyplot's global state and interactive backend
+    fig = Figure(figsize=(8, 6))
+    FigureCanvasAgg(fig)
+    draw_rankings(fig.add_subplot(), embeddings_2d, colors, method)
+    fig.savefig(output)
+
+
+def visualize_rankings_with_tsne(query, top_vectors, selected_indices_mmr, selected_indices_dr, selected_indices_db, perplexity=5, **kwargs):
+    visualize_rankings(query, top_vectors, selected_indices_mmr, selected_indices_dr, selected_indices_db, method="tsne", perplexity=perplexity, **kwargs)
+
+
+def visualize_rankings_with_pca(query, top_vectors, selected_indices_mmr, selected_indices_dr, selected_indices_db, **kwargs):
+    visualize_rankings(query, top_vectors, selected_indices_mmr, selected_indices_dr, selected_indices_db, method="pca", **kwargs)
+
+
+def render_topic(job):
+    # process pool entry point, job is the keyword arguments of visualize_rankings
+    visualize_rankings(**job)
+    return job["output"]
+
+
+def render_batch(records, output_dir, method="pca", fmt="png", workers=None, pca_path=None):
     """
-    # Convert the selected indices to sets for easier comparison
-    mmr_set = set(selected_indices_mmr)
-    dr_set = set(selected_indices_dr)
-    db_set = set(selected_indices_db)
-
-    # Initialize an array to store the color category for each document
-    num_vectors = len(top_vectors)
-    colors = np.zeros(num_vectors)
-
-    # Assign color codes based on the sets
-    for i in range(num_vectors):
-        in_mmr = i in mmr_set
-        in_dr = i in dr_set
-        in_db = i in db_set
-
-        # Assign a unique number for each combination
-        if in_mmr and in_dr and in_db:
-            colors[i] = 7  # Selected by all three
-        elif in_mmr and in_dr:
-            colors[i] = 6  # Selected by MMR and DR
-        elif in_mmr and in_db:
-            colors[i] = 5  # Selected by MMR and DB
-        elif in_dr and in_db:
-            colors[i] = 4  # Selected by DR and DB
-        elif in_mmr:
-            colors[i] = 3  # Selected only by MMR
-        elif in_dr:
-            colors[i] = 2  # Selected only by DR
-        elif in_db:
-            colors[i] = 1  # Selected only by DB
-        else:
-            colors[i] = 0  # Not selected by any
-
-    # Get the query embedding
-    query_data = {"text": query}
-    response = requests.post(embedding_url, json=query_data)
-    query_embedding = response.json()["embedding"]
-
-    # Append the query_embedding to top_vectors for PCA
-    all_vectors = np.vstack([top_vectors, query_embedding])
-
-    # Apply PCA to reduce dimensions to 2D
-    pca = PCA(n_components=2)
-    embeddings_2d = pca.fit_transform(np.array(all_vectors))
-
-    # Extract the 2D position of the query embedding (last one)
-    query_2d = embeddings_2d[-1]
-
-    # Create a color map
-    colormap = plt.cm.get_cmap('tab10', 8)  # Using a colormap with 8 distinct colors
-
-    # Plot the document embeddings with color coding
-    plt.figure(figsize=(8, 6))
-    scatter = plt.scatter(embeddings_2d[:-1, 0], embeddings_2d[:-1, 1], c=colors, cmap=colormap, s=100)
-
-    # Plot the query embedding separately in red
-    plt.scatter(query_2d[0], query_2d[1], color='red', marker='x', s=200, label="Query")
-
-    # Add text annotations for each point (display the index number)
-    for i in range(len(embeddings_2d) - 1):
-        plt.text(embeddings_2d[i, 0], embeddings_2d[i, 1], str(i), fontsize=9, ha='right')
+    Write one plot per topic without any interactive backend.
 
-    # Create a legend for the color categories
-    legend_labels = ['Not selected', 'DB only', 'DR only', 'MMR only', 'DR & DB', 'MMR & DB', 'MMR & DR', 'All three']
-    plt.legend(handles=scatter.legend_elements()[0], labels=legend_labels, title="Selection")
-    plt.legend(loc="best")
+    All queries are embedded with a single vectorize_batch call. With PCA one
+    basis is fitted over every topic's documents and queries (or loaded from
+    pca_path) and shared by all plots. Projections and drawing run in a
+    process pool.
 
-    plt.title('PCA Visualization of Document Embeddings with Query')
-    plt.xlabel('PCA Dimension 1')
-    plt.ylabel('PCA Dimension 2')
-    plt.show()
+    Args:
+    - records (list): Dicts with topic_id, topic, vectors and rankings (strategy name mapped to indices).
+    - output_dir (str): Directory of the plots, named <topic_id>_<method>.<fmt>.
+    - method (str): "pca" or "tsne".
+    - fmt (str): Image format, e.g. "png" or "svg".
+    - workers (int): Number of processes, defaults to the number of CPUs.
+    - pca_path (str): .npz file caching the shared PCA basis.
+
+    Returns:
+    - list: Paths of the written plots.
+    """
+    os.makedirs(output_dir, exist_ok=True)
+    query_embeddings = vectorize_batch([record["topic"] for record in records])
+
+    pca_basis = None
+    if method == "pca":
+        pca_basis = fit_pca(np.vstack([record["vectors"] for record in records] + [query_embeddings]), pca_path)
+
+    jobs = [
+        dict(
+            query=record["topic"],
+            top_vectors=record["vectors"],
+            selected_indices_mmr=record["rankings"]["mmr"],
+            selected_indices_dr=record["rankings"]["dr"],
+            selected_indices_db=record["rankings"]["db"],
+            method=method,
+            query_embedding=query_embedding,
+            output=os.path.join(output_dir, f"{record['topic_id']}_{method}.{fmt}"),
+            pca_basis=pca_basis,
+        )
+        for record, query_embedding in zip(records, query_embeddings)
+    ]
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        return list(pool.map(render_topic, jobs, chunksize=max(1, len(jobs) // (4 * (workers or os.cpu_count())))))
+
+
+if __name__ == "__main__":
+    from topics import TopicRegistry, DEFAULT_TOPICS_FILES
+    from snapshot import SnapshotStore
+    from utilities import RerankContext, rerank_indices
+
+    parser = argparse.ArgumentParser(description="Plot every topic's candidates and their rankings from a snapshot")
+    parser.add_argument("--topics", nargs="+", default=DEFAULT_TOPICS_FILES, help="topic files, the first one wins for duplicate ids")
+    parser.add_argument("--snapshot", default="./snapshots/rag24", help="snapshot directory with the candidate vectors")
+    parser.add_argument("--output", default="./output/plots", help="directory of the plots")
+    parser.add_argument("--method", choices=["pca", "tsne"], default="pca")
+    parser.add_argument("--format", default="png", help="image format, e.g. png or svg")
+    parser.add_argument("--depth", type=int, default=20, help="number of candidates plotted per topic")
+    parser.add_argument("--top-n", type=int, default=5, help="number of documents selected by every strategy")
+    parser.add_argument("--workers", type=int, default=None, help="number of rendering processes")
+    parser.add_argument("--pca-cache", default=None, help=".npz file to store and reuse the shared PCA basis")
+    args = parser.parse_args()
+
+    store = SnapshotStore(args.snapshot)
+    records = []
+    for topic_id, topic in TopicRegistry(args.topics).as_dict().items():
+        if topic not in store:
+            continue
+        _, top_vectors, query_similarities = store.retrieve(topic, args.depth)
+        rankings = rerank_indices(RerankContext(top_vectors, query_similarities), args.top_n)
+        records.append({"topic_id": topic_id, "topic": topic, "vectors": np.asarray(top_vectors), "rankings": rankings})
+
+    paths = render_batch(records, args.output, args.method, args.format, args.workers, args.pca_cache)
+    print(f"Wrote {len(paths)} plots to {args.output}")
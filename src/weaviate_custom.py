@@ -1,46 +1,207 @@
-import weaviate
-from weaviate.classes.query import MetadataQuery
+import asyncio
+import numpy as np
+from metrics import span
+
+connection_params = dict(
+    http_host="weaviatedb.srv.webis.de",
+    http_port=80,
+    http_secure=False,
+    grpc_host="weaviateinference.srv.webis.de",
+    grpc_port=80,
+    grpc_secure=False,
+    skip_init_checks=True,
+)
+
+
+def missing_vector_ids(objects):
+    # objects that came back from the search without their 'default' vector
+    return [o.uuid for o in objects if "default" not in (o.vector or {})]
+
+
+def unpack_results(objects, fetched, with_ids=False):
+    """
+    Turn search result objects into the (documents, vectors, similarities) triple,
+    with the vectors stacked into one contiguous float32 matrix. With with_ids
+    the segment UUIDs are appended as a fourth element.
+    """
+    top_documents = [o.properties["segment"] for o in objects]
+    query_similarities = [o.metadata.certainty for o in objects]
+
+    rows = [fetched[o.uuid] if o.uuid in fetched else o.vector["default"] for o in objects]
+    if not rows:
+        top_vectors = np.empty((0, 0), dtype=np.float32)
+    else:
+        top_vectors = np.ascontiguousarray(rows, dtype=np.float32)
+
+    if with_ids:
+        return top_documents, top_vectors, query_similarities, [str(o.uuid) for o in objects]
+    return top_documents, top_vectors, query_similarities
+
 
 class weaviate_custom:
-    def __init__(self):
-        pass
-    
+    def __init__(self, query_vectorizer=None):
+        # optional callable mapping a query to its embedding, e.g. embedding_client.cached_vectorize.
+        # when set, queries are searched with near_vector instead of the server side vectorizer
+        self.query_vectorizer = query_vectorizer
+
     def db_connect(self):
-        self.client = weaviate.connect_to_custom(
-            http_host="weaviatedb.srv.webis.de",  
-            http_port=80,                       
-            http_secure=False,   
-            grpc_host="weaviateinference.srv.webis.de",  
-            grpc_port=80,                       
-            grpc_secure=False,
-            skip_init_checks=True,
-        )
+        # the Weaviate client is a heavy import, it is only loaded by the backends that connect to it
+        import weaviate
+        self.client = weaviate.connect_to_custom(**connection_params)
         self.collection = self.client.collections.get("Segments")
-        
+
     def db_disconnect(self):
         self.client.close()
 
-    def retrieve(self, query, top_n):
-        # get embeddings and put them into a list
-        def get_data(objects):
-            for o in objects:
-                o_with_vector = self.collection.query.fetch_object_by_id(o.uuid, include_vector= True)
-                vector = o_with_vector.vector['default']
-
-                top_documents.append(o.properties["segment"])
-                top_vectors.append(vector)
-                query_similarities.append(o.metadata.certainty)
-            return top_documents, top_vectors, query_similarities
-        
-        top_documents = []
-        top_vectors = []
-        query_similarities = []
-
-        response = self.collection.query.near_text(
+    def hydrate_vectors(self, objects):
+        """
+        Fetch the 'default' vectors of objects that came back without one.
+
+        Vectors returned with the search result are used directly, the rest are
+        fetched in a single bulk query keyed by UUID instead of one
+        fetch_object_by_id call per hit.
+        """
+        from weaviate.classes.query import Filter
+        missing = missing_vector_ids(objects)
+        if not missing:
+            return {}
+        response = self.collection.query.fetch_objects(
+                    filters=Filter.by_id().contains_any(missing),
+                    limit=len(missing),
+                    include_vector=True
+                )
+        return {o.uuid: o.vector["default"] for o in response.objects}
+
+    def search(self, query, top_n):
+        # segment text, certainty and vector come back with the same query
+        from weaviate.classes.query import MetadataQuery
+        if self.query_vectorizer is not None:
+            return self.collection.query.near_vector(
+                        near_vector=[float(x) for x in self.query_vectorizer(query)],
+                        limit=top_n,
+                        include_vector=True,
+                        return_metadata=MetadataQuery(distance=True, certainty=True)
+                    )
+        return self.collection.query.near_text(
                     query=query,
                     limit=top_n,
+                    include_vector=True,
                     return_metadata=MetadataQuery(distance=True, certainty=True)
                 )
-        
-        return get_data(response.objects)
-    
+
+    def retrieve(self, query, top_n, with_ids=False):
+        with span("search"):
+            response = self.search(query, top_n)
+        with span("hydrate"):
+            fetched = self.hydrate_vectors(response.objects)
+        return unpack_results(response.objects, fetched, with_ids)
+
+
+class weaviate_custom_async(weaviate_custom):
+    """
+    Same interface as weaviate_custom on top of the async Weaviate client,
+    every method is a coroutine and never blocks the event loop.
+    """
+    async def db_connect(self):
+        import weaviate
+        self.client = weaviate.use_async_with_custom(**connection_params)
+        await self.client.connect()
+        self.collection = self.client.collections.get("Segments")
+
+    async def db_disconnect(self):
+        await self.client.close()
+
+    async def hydrate_vectors(self, objects):
+        from weaviate.classes.query import Filter
+        missing = missing_vector_ids(objects)
+        if not missing:
+            return {}
+        response = await self.collection.query.fetch_objects(
+                    filters=Filter.by_id().contains_any(missing),
+                    limit=len(missing),
+                    include_vector=True
+                )
+        return {o.uuid: o.vector["default"] for o in response.objects}
+
+    async def search(self, query, top_n):
+        from weaviate.classes.query import MetadataQuery
+        if self.query_vectorizer is not None:
+            # the vectorizer is a blocking call, keep it off the event loop
+            query_vector = await asyncio.to_thread(self.query_vectorizer, query)
+            return await self.collection.query.near_vector(
+                        near_vector=[float(x) for x in query_vector],
+                        limit=top_n,
+                        include_vector=True,
+                        return_metadata=MetadataQuery(distance=True, certainty=True)
+                    )
+        return await self.collection.query.near_text(
+                    query=query,
+                    limit=top_n,
+                    include_vector=True,
+                    return_metadata=MetadataQuery(distance=True, certainty=True)
+                )
+
+    async def retrieve(self, query, top_n, with_ids=False):
+        with span("search"):
+            response = await self.search(query, top_n)
+        with span("hydrate"):
+            fetched = await self.hydrate_vectors(response.objects)
+        return unpack_results(response.objects, fetched, with_ids)
+
+
+class weaviate_custom_offline:
+    """
+    Serves retrieve from a local snapshot written by snapshot.py instead of the
+    remote Segments collection, with the same interface as weaviate_custom.
+    """
+    def __init__(self, snapshot_path):
+        self.snapshot_path = snapshot_path
+
+    def db_connect(self):
+        from snapshot import SnapshotStore
+        self.store = SnapshotStore(self.snapshot_path)
+
+    def db_disconnect(self):
+        self.store = None
+
+    def retrieve(self, query, top_n, with_ids=False):
+        return self.store.retrieve(query, top_n, with_ids)
+
+
+class weaviate_custom_offline_async(weaviate_custom_offline):
+    # coroutine interface of weaviate_custom_async, reads from the memory-mapped snapshot
+    async def db_connect(self):
+        super().db_connect()
+
+    async def db_disconnect(self):
+        super().db_disconnect()
+
+    async def retrieve(self, query, top_n, with_ids=False):
+        return super().retrieve(query, top_n, with_ids)
+
+
+class weaviate_custom_local(weaviate_custom_offline):
+    """
+    Searches a LocalIndex (see local_index.py) instead of the remote Segments
+    collection, for load tests and degraded-mode operation without the cluster.
+    """
+    def __init__(self, index_path, query_vectorizer=None, nprobe=8):
+        self.index_path = index_path
+        self.query_vectorizer = query_vectorizer
+        self.nprobe = nprobe
+
+    def db_connect(self):
+        from local_index import LocalIndex
+        self.store = LocalIndex(self.index_path, self.query_vectorizer, self.nprobe)
+
+
+class weaviate_custom_local_async(weaviate_custom_local):
+    # the query encoding and the search are CPU bound, they run on a worker thread
+    async def db_connect(self):
+        super().db_connect()
+
+    async def db_disconnect(self):
+        super().db_disconnect()
+
+    async def retrieve(self, query, top_n, with_ids=False):
+        return await asyncio.to_thread(self.store.retrieve, query, top_n, with_ids)